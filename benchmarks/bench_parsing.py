@@ -0,0 +1,77 @@
+"""
+html片段解析的性能测试
+
+fixture目录中按接口存放抓取的返回内容(html片段原文), 文件名前缀决定使用的解析函数:
+    op_log*.html         get_order_op_log的message
+    combo_sku*.html      get_combo_sku_info_list的message
+    logistics*.html      订单的cansend1logisticsHtml
+    related_order*.html  get_order_ext_info的order_html
+    shipping_fee*.html   镖局doCalculate的calculationRetHtml
+
+benchmarks/fixtures中为按马帮返回格式构造的合成数据(不含真实订单), 可换成实际抓取的返回内容.
+
+用法:
+    python benchmarks/bench_parsing.py -n 200
+    python benchmarks/bench_parsing.py captured/ -n 200
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mbapi import parsing  # noqa: E402
+
+
+DEFAULT_FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+PARSERS = {
+    'op_log': parsing.parse_op_log_rows,
+    'combo_sku': lambda text: [parsing.parse_combo_sku_row(tr) for tr in parsing.parse_combo_sku_rows(text)],
+    'logistics': lambda text: [parsing.parse_logistics_ship_serv(text)],
+    'related_order': parsing.parse_related_order_rows,
+    'shipping_fee': parsing.parse_shipping_fee_detail_rows,
+}
+
+
+def get_parser(filename):
+    # 长前缀优先, 避免被短前缀误匹配
+    for prefix in sorted(PARSERS, key=len, reverse=True):
+        if filename.startswith(prefix):
+            return prefix, PARSERS[prefix]
+    return None, None
+
+
+def bench(func, text, number):
+    rows = len(func(text))
+    start = time.perf_counter()
+    for _ in range(number):
+        func(text)
+    duration = time.perf_counter() - start
+    return rows, duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description='html片段解析的性能测试')
+    parser.add_argument(
+        'fixture_dir', nargs='?', default=DEFAULT_FIXTURE_DIR, help='存放返回内容的目录, 默认为benchmarks/fixtures'
+        )
+    parser.add_argument('-n', '--number', type=int, default=100, help='每个文件的解析次数')
+    args = parser.parse_args()
+
+    print(f'{"fixture":<40}{"rows":>8}{"ms/parse":>12}{"rows/s":>14}')
+    for filename in sorted(os.listdir(args.fixture_dir)):
+        name, func = get_parser(filename)
+        if func is None:
+            continue
+        with open(os.path.join(args.fixture_dir, filename), encoding='utf-8') as f:
+            text = f.read()
+        rows, duration = bench(func, text, args.number)
+        per_parse = duration / args.number
+        rows_per_second = rows * args.number / duration if duration else 0
+        print(f'{filename:<40}{rows:>8}{per_parse * 1000:>12.3f}{rows_per_second:>14.0f}')
+
+
+if __name__ == '__main__':
+    main()
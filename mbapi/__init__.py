@@ -1,21 +1,25 @@
 # -*- coding: utf-8 -*-
 import re
 import io
+import os
+import tempfile
 import logging
 import json
 import time
 import uuid
-import copy
+import zipfile
+from datetime import datetime
 from types import MethodType
 from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 import pandas as pd
 # from retry import retry
-from lxml import html
 from openpyxl import Workbook, load_workbook
-from openpyxl.writer.excel import save_virtual_workbook
+from openpyxl.utils.exceptions import InvalidFileException
 
+from .base import LOGIN_CHECK_DOMAINS
 from .product import ProductApi
 from .constant import (
     COUNTRY_CODE_MAP,
@@ -40,8 +44,13 @@ from .exceptions import (
 from .config import (
     STOCK_WAREHOUSE_ID, STOCK_GRID_ID, ORDER_UPLOAD_TEMPLATE_ID_MAP, ORDER_DOWNLOAD_TEMPLATE_ID_MAP
 )
-from .product import ProductSearchOperate, Product
+from .product import ProductSearchOperate, Product, StockProductSearchKey, ComboProductSearchKey
 from .biaoju import BiaoJuApi
+from .filelock import file_lock
+from .multipart import MultipartEncoder, XLSX_CONTENT_TYPE
+from .tracing import traced, bind_span
+from .columnar import convert_rows
+from .parsing import parse_op_log_rows, parse_logistics_ship_serv, parse_related_order_rows
 
 
 logger = logging.getLogger(__name__)
@@ -78,6 +87,9 @@ API_MAP = {
     'votobo_check_login': f'{VOTOBO_BASE_URL}/api/index.php?mod=messageNotice.messageList&type=1',
     ## votobo api
     'votobo_api': f'{VOTOBO_BASE_URL}/api/index.php',
+    # 镖局
+    ## 镖局登录
+    'biaoju_login': f"{BIAOJU_API}?m=main&a=erpLogin&noHeader=1&plus=eyJob3N0IjoiaHR0cHM6XC9cL3d3dy5tYWJhbmdlcnAuY29tXC9pbmRleC5waHAifQ==&loginMod=customshippingfee.list&i=8932&language=cn&lang=cn",
     }
 
 
@@ -91,20 +103,44 @@ PLATFORM_ID_MAP = {
     }
 
 
+# 按订单id批量搜索时每次搜索的订单数量及每页订单数量
+ORDER_SEARCH_CHUNK_SIZE = 100
+ORDER_SEARCH_PAGE_SIZE = 100
+
+
+# 分块导出订单时每块的订单数量
+EXPORT_CHUNK_SIZE = 500
+# 流式下载导出表格时每次读取的字节数
+EXPORT_DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+
+# 查找合并订单主订单的最大层数
+MERGE_ORDER_MAX_DEPTH = 5
+
+
 ShippingInfo = namedtuple('shipping_info', 'order_id shipping_service tracking_no')
 
 
 class MBApi(ProductApi, BiaoJuApi):
+    '''马帮接口
+    实例可在多个线程间共享: 登录及登录检测同一时刻只在一个线程中进行,
+    多个线程同时发现登录失效时只会重新登录一次
+    '''
+    @traced
     def request(self, method, url, login_for_error=True, **kw):
-        logger.info(f'url={url}, method={method}, kw={kw}')
-        new_kw = copy.deepcopy(kw)
+        self.log_policy.log_request(logger, method, url, kw)
+        # 不复制kw, 重试时只需把文件类参数回退到原来的位置
         headers = {'X-Requested-With': 'XMLHttpRequest'}
-        headers.update(new_kw.pop('headers', {}))
+        headers.update(kw.get('headers', {}))
+        new_kw = {k: v for k, v in kw.items() if k != 'headers'}
+        file_positions = self._get_file_positions(kw)
+        login_generation = self._login_generation
+        endpoint = self.metrics.get_endpoint(url, kw.get('params'))
         try:
-            r = self.r_session.request(method, url, headers=headers, **new_kw)
+            r = self._session_request(method, url, endpoint=endpoint, headers=headers, **new_kw)
         except requests.exceptions.RequestException as e:
             raise MBApiRequestError('mb无法访问', e)
-        logger.info("mb返回: %s", r.text)
+        self.log_policy.log_response(logger, 'mb', r)
         if r.status_code != 200:
             raise MBApiRequestError('请求mb接口出错, 返回状态码为: %s', r.status_code)
         try:
@@ -114,41 +150,127 @@ class MBApi(ProductApi, BiaoJuApi):
         if not ret_data['success']:
             if login_for_error and self._check_login_invalid(ret_data["message"]):
                 logger.info(f"登录信息超时，重新登录")
-                self.login()
+                self.metrics.inc(endpoint, 'relogins')
+                self._relogin(login_generation)
+                for fp, position in file_positions:
+                    fp.seek(position)
                 return self.request(method, url, login_for_error=False, **kw)
+            self.metrics.inc(endpoint, 'biz_errors')
             raise MBApiBizError('请求mb接口出错, 返回数据为: %s', ret_data)
         if ret_data.get("errorMessage"):
+            self.metrics.inc(endpoint, 'biz_errors')
             raise MBApiBizError("调用mb接口成功，但出现错误: %s" % ret_data["errorMessage"])
         return ret_data
 
-    def _check_login(self):
-        aamz_text = self._r_session.get(AAMZ_API).text
-        mb_text = self._r_session.get(API_MAP['index']).text
-        votobo_json = self._r_session.get(API_MAP['votobo_check_login']).json()
-        # 登录标记
-        login_flag = '企业编号'
-        if login_flag in mb_text and login_flag in aamz_text and votobo_json['success']:
+    def _session_request(self, method, url, endpoint=None, **kw):
+        '''通过已登录的session发送请求, 并记录请求指标及调用追踪
+        :param endpoint: 接口名, 为None时根据url及params获取
+        '''
+        if endpoint is None:
+            endpoint = self.metrics.get_endpoint(url, kw.get('params'))
+        r_session = self._get_session(url)
+        with self.tracer.span('http', endpoint=endpoint, method=method) as span:
+            start = time.monotonic()
+            try:
+                r = r_session.request(method, url, **kw)
+            except requests.exceptions.RequestException:
+                self.metrics.observe(endpoint, time.monotonic() - start)
+                raise
+            span.status = r.status_code
+            span.retries = self._observe_response(endpoint, time.monotonic() - start, r, kw.get('stream', False))
+        return r
+
+    def _observe_response(self, endpoint, duration, r, stream=False):
+        '''记录请求指标, 返回urllib3重试次数'''
+        body = r.request.body
+        if body is None:
+            request_bytes = 0
+        elif isinstance(body, (bytes, str)):
+            request_bytes = len(body)
+        else:
+            request_bytes = len(body) if hasattr(body, '__len__') else 0
+        retries = getattr(r.raw, 'retries', None)
+        retry_count = len(retries.history) if retries is not None else 0
+        self.metrics.observe(
+            endpoint, duration,
+            status=r.status_code,
+            request_bytes=request_bytes,
+            # 流式请求不读取返回内容, 以Content-Length计
+            response_bytes=int(r.headers.get('Content-Length', 0)) if stream else len(r.content),
+            retries=retry_count,
+            )
+        return retry_count
+
+    @staticmethod
+    def _get_file_positions(kw):
+        '''获取请求参数中文件对象的当前位置'''
+        files = kw.get('files') or {}
+        file_values = files.values() if isinstance(files, dict) else [value for _, value in files]
+        fps = [value[1] if isinstance(value, (tuple, list)) else value for value in file_values]
+        fps.append(kw.get('data'))
+        return [(fp, fp.tell()) for fp in fps if hasattr(fp, 'seek') and hasattr(fp, 'tell')]
+
+    def _check_login(self, domains=LOGIN_CHECK_DOMAINS):
+        '''并发检测各登录域的登录状态, 任一登录域失效则重新登录'''
+        with ThreadPoolExecutor(max_workers=len(domains) or 1) as executor:
+            results = list(executor.map(self._check_domain_login, domains))
+        if all(results):
             logger.info('%s 登陆状态正常', self.user)
             self.login_error_times = 0
+            now = datetime.now()
+            for domain in domains:
+                self._login_datetimes[domain] = now
+            self._save_session()
         else:
             self.login_error_times += 1
             if self.login_error_times < 3:
                 return self.login()
             raise LoginError("MB登录失败")
 
+    def _check_domain_login(self, domain):
+        '''检测单个登录域的登录状态'''
+        # 登录标记
+        login_flag = '企业编号'
+        if domain == 'mb':
+            return login_flag in self._r_session.get(API_MAP['index']).text
+        if domain == 'aamz':
+            return login_flag in self._r_session.get(AAMZ_API).text
+        if domain == 'votobo':
+            return self._r_session.get(API_MAP['votobo_check_login']).json()['success']
+        return True
+
+    @traced
     def login(self):
         # TODO: 处理login和check_login循环调用的问题
+        with self._login_lock:
+            # 在新session上登录, 登录完成后再替换, 登录过程中其他线程仍使用旧session
+            r_session = self._make_request_session()
+            c_mkey = self._login_mb(r_session)
+            # 其他登录域只依赖mb的登录cookie, 可并发登录
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                futures = [
+                    executor.submit(self._login_aamz, r_session, c_mkey),
+                    executor.submit(self._login_votobo, r_session),
+                    executor.submit(self._login_biaoju, r_session),
+                    ]
+                for future in futures:
+                    future.result()
+            self._r_session = r_session
+            self._login_generation += 1
+            self._check_login()
+
+    def _login_mb(self, r_session):
         logger.info('登陆mb: %s' % self.user)
         login_api = API_MAP['login']
         data = {'username': self.user, 'password': self.passwd}
-        r = self._r_session.post(login_api, data=data)
+        r = r_session.post(login_api, data=data)
         r_json = r.json()
-        logger.info('登录返回信息: %s', r_json)
+        self.log_policy.log_response(logger, '登录', r)
         if not r_json['success']:
             raise LoginError('MB登录失败')
+        return r.cookies["MABANG_ERP_PRO_MEMBERINFO_LOGIN_COOKIE"]
 
-        c_mkey = r.cookies["MABANG_ERP_PRO_MEMBERINFO_LOGIN_COOKIE"]
-
+    def _login_aamz(self, r_session, c_mkey):
         # 为AAMZ_API注册好Cookie
         aamz_params = {
             'mod': 'stock.list',
@@ -156,22 +278,21 @@ class MBApi(ProductApi, BiaoJuApi):
             'cMKey': c_mkey,
             'lang': 'cn',
             }
-        resp = self._r_session.get(AAMZ_API, params=aamz_params)
-        logger.info('登录AAMZ返回信息: %s', resp.text[:150])
+        resp = r_session.get(AAMZ_API, params=aamz_params)
+        self.log_policy.log_response(logger, '登录AAMZ', resp)
 
+    def _login_votobo(self, r_session):
         votobo_params = {
             "mod": "vmain.mbLogin",
             "mbkey": f"md_MABANG_ERP_PRIVATE_LOGIN_{self.business_number}_{self.user_id}_M0010806",
             "private_mabang": "",
         }
-        resp = self._r_session.get(API_MAP['votobo_login'], params=votobo_params)
-        logger.info('登录votobo返回信息: %s', resp.json())
+        resp = r_session.get(API_MAP['votobo_login'], params=votobo_params)
+        self.log_policy.log_response(logger, '登录votobo', resp)
 
-        # 登陆镖局
-        biaoju_login_api = f"{BIAOJU_API}?m=main&a=erpLogin&noHeader=1&plus=eyJob3N0IjoiaHR0cHM6XC9cL3d3dy5tYWJhbmdlcnAuY29tXC9pbmRleC5waHAifQ==&loginMod=customshippingfee.list&i=8932&language=cn&lang=cn"
-        resp = self._r_session.get(biaoju_login_api)
-        logger.info("登陆镖局返回信息: %s", resp.text)
-        self._check_login()
+    def _login_biaoju(self, r_session):
+        resp = r_session.get(API_MAP['biaoju_login'])
+        self.log_policy.log_response(logger, '登陆镖局', resp)
 
     # def get_shipping_fee(self, weight, country='US'):
     #     '''获取邮费, 只支持e邮宝'''
@@ -192,22 +313,20 @@ class MBApi(ProductApi, BiaoJuApi):
 
     def upload_virtual_sku_from_file(self, xlsx_name):
         '''上传虚拟SKU'''
-        api = API_MAP['upload_virtual_sku']
-        files = {'templetfile': open(xlsx_name, 'rb')}
-        data = {
-            "UpLoadFileType": "addVirtualSKU",
-            "stockVirtualType": 1
-        }
-        ret_data = self.request("post", api, data=data, files=files)
-        logger.info('上传sku: %s, 返回数据:%s' % (xlsx_name, ret_data))
+        with open(xlsx_name, 'rb') as fp:
+            ret_data = self._upload_virtual_sku_xlsx(os.path.basename(xlsx_name), fp)
+        logger.info('上传sku: %s, 返回数据:%s', xlsx_name, ret_data)
+        if self.product_cache is not None:
+            # 无法得知文件中的sku, 作废全部缓存
+            self.product_cache.invalidate()
         return ret_data
 
+    @traced
     def upload_virtual_sku(self, mb_sku_map_list):
         '''上传sku对
         :param mb_sku_map_list: (mb_sku, vir_sku)...
         '''
-        logger.info('上传sku: %s' % mb_sku_map_list)
-        api = API_MAP['upload_virtual_sku']
+        logger.info('上传sku: %s', mb_sku_map_list)
         wb = Workbook()
         ws = wb.active
         ws['A1'] = '*库存sku编号'
@@ -215,20 +334,37 @@ class MBApi(ProductApi, BiaoJuApi):
         for num, (mb_sku, vir_sku) in enumerate(mb_sku_map_list, 2):
             ws['A%s' % num] = mb_sku
             ws['B%s' % num] = vir_sku
-        fp = io.BytesIO(save_virtual_workbook(wb))
-        fp.name = 'test.xlsx'
-        files = {'templetfile': fp}
-        data = {
-            "UpLoadFileType": "addVirtualSKU",
-            "stockVirtualType": 1
-        }
-        ret_data = self.request("post", api, data=data, files=files)
-        logger.info('上传sku: %s, 返回数据:%s' % (mb_sku_map_list, ret_data))
+        with tempfile.TemporaryFile() as fp:
+            wb.save(fp)
+            fp.seek(0)
+            ret_data = self._upload_virtual_sku_xlsx('test.xlsx', fp)
+        logger.info('上传sku: %s, 返回数据:%s', mb_sku_map_list, ret_data)
+        self._invalidate_product_cache(mb_sku_map_list)
         return ret_data
 
-    def exist_virtual_sku(self, vir_sku):
+    def _upload_virtual_sku_xlsx(self, filename, fp):
+        '''流式上传虚拟SKU表格'''
+        api = API_MAP['upload_virtual_sku']
+        data = [
+            ("UpLoadFileType", "addVirtualSKU"),
+            ("stockVirtualType", 1),
+        ]
+        body = MultipartEncoder(data, [('templetfile', filename, fp, XLSX_CONTENT_TYPE)])
+        return self.request("post", api, data=body, headers={'Content-Type': body.content_type})
+
+    def _invalidate_product_cache(self, mb_sku_map_list):
+        '''上传sku对后作废相关的商品查询缓存'''
+        if self.product_cache is None:
+            return
+        for mb_sku, vir_sku in mb_sku_map_list:
+            self.product_cache.invalidate_sku(vir_sku, [StockProductSearchKey.VIRTUAL_SKU])
+            self.product_cache.invalidate_sku(
+                mb_sku, [StockProductSearchKey.STOCK_SKU, ComboProductSearchKey.COMBO_SKU]
+                )
+
+    def exist_virtual_sku(self, vir_sku, operate=ProductSearchOperate.LIKE_START, live=False):
         try:
-            if self.get_product_info_from_virtual_sku(vir_sku):
+            if self.get_product_info_from_virtual_sku(vir_sku, operate, live=live):
                 return True
             else:
                 return False
@@ -237,21 +373,133 @@ class MBApi(ProductApi, BiaoJuApi):
         except ProductMultiError:
             return True
 
-    def get_newest_virtual_sku(self, vir_sku):
-        '''判断该类型的虚拟sku的最小未使用的虚拟sku
-        param vir_sku: 根据这个vir_sku返回对应的最小未使用的虚拟sku
+    @traced
+    def get_newest_virtual_sku(self, vir_sku, gap_fill=False, live=False):
+        '''返回该类型的虚拟sku中已使用的最大编号之后的下一个虚拟sku
+        param vir_sku: 虚拟sku前缀及起始编号, 返回的编号不小于vir_sku
+        param gap_fill: 为False时按编号逐位查找已使用的最大编号, 只需O(编号位数)轮查询;
+            为True时沿用原来的逐个查询, 返回vir_sku之后最小的未使用编号(可填补中间的空缺编号),
+            需O(n)轮查询, n为vir_sku之后已连续使用的编号数
+        param live: 是否跳过product_cache及product_index直接请求马帮接口
         '''
-        def next_sku(sku):
-            sku_re = re.compile(r'([A-Za-z]+)(\d+)')
-            prefix, num = sku_re.match(sku).groups()
-            new_num = int(num) + 1
-            return '%s%0{}d'.format(len(num)) % (prefix, new_num)
+        prefix, num, width = self._split_virtual_sku(vir_sku)
 
-        while True:
-            logger.debug('测试vir_sku [%s] 是否存在' % vir_sku)
-            if not self.exist_virtual_sku(vir_sku):
-                return vir_sku
-            vir_sku = next_sku(vir_sku)
+        if gap_fill:
+            def exist(n):
+                sku = self._format_virtual_sku(prefix, n, width)
+                logger.debug('测试vir_sku [%s] 是否存在', sku)
+                return self.exist_virtual_sku(sku, live=live)
+
+            while exist(num):
+                num += 1
+            return self._format_virtual_sku(prefix, num, width)
+
+        highest = self._get_highest_virtual_sku_num(prefix, width, live)
+        if highest is None or highest < num:
+            return vir_sku
+        return self._format_virtual_sku(prefix, highest + 1, width)
+
+    def _get_highest_virtual_sku_num(self, prefix, width, live=False):
+        '''已使用的最大编号, 没有已使用的编号时返回None
+        编号位数固定, 以编号前几位做like_start查询即可判断对应区间内是否有已使用的编号,
+        从高位到低位每轮并发查询10个数字, 取存在的最大数字
+        '''
+        digits = ''
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            for _ in range(width):
+                candidates = [digits + str(d) for d in range(10)]
+                exists = executor.map(
+                    bind_span(lambda candidate: self.exist_virtual_sku(prefix + candidate, live=live)), candidates
+                    )
+                used = [candidate for candidate, exist in zip(candidates, exists) if exist]
+                if not used:
+                    if not digits:
+                        return None
+                    # 前缀匹配到的是非纯数字编号(如AB01-A), 保守地视为该区间已全部使用
+                    return int(digits.ljust(width, '9'))
+                digits = used[-1]
+        return int(digits)
+
+    @staticmethod
+    def _split_virtual_sku(vir_sku):
+        '''拆分虚拟sku为(前缀, 编号, 编号位数)'''
+        prefix, num = re.match(r'([A-Za-z]+)(\d+)', vir_sku).groups()
+        return prefix, int(num), len(num)
+
+    @staticmethod
+    def _format_virtual_sku(prefix, num, width):
+        return '%s%0{}d'.format(width) % (prefix, num)
+
+    @traced
+    def allocate_virtual_skus(self, vir_sku, n, mb_skus, gap_fill=False):
+        '''批量分配n个未使用的虚拟sku并上传
+        分配过程持有本机文件锁, 同一主机上的多个进程不会分配到相同的虚拟sku
+        :param vir_sku: 虚拟sku的起始编号, 如AB0001
+        :param n: 分配数量
+        :param mb_skus: 对应的库存sku列表, 长度为n; 或者单个库存sku, 所有虚拟sku都对应该库存sku
+        :param gap_fill: 为False时分配已使用编号之后的连续编号; 为True时优先填补中间的空缺编号
+        :return: [(mb_sku, vir_sku)...]
+        '''
+        if isinstance(mb_skus, str):
+            mb_skus = [mb_skus] * n
+        if len(mb_skus) != n:
+            raise ValueError(f'mb_skus数量[{len(mb_skus)}]与分配数量[{n}]不一致')
+        if n <= 0:
+            return []
+        prefix, num, width = self._split_virtual_sku(vir_sku)
+        lock_path = os.path.join(tempfile.gettempdir(), 'mbapi', f'virtual_sku_{prefix}.lock')
+        # 持有锁期间的查询均跳过product_cache及product_index, 避免读到其他进程分配前的旧结果
+        with file_lock(lock_path):
+            while True:
+                if gap_fill:
+                    vir_skus = []
+                    next_num = num
+                    while len(vir_skus) < n:
+                        sku = self.get_newest_virtual_sku(
+                            self._format_virtual_sku(prefix, next_num, width), gap_fill=True, live=True
+                            )
+                        vir_skus.append(sku)
+                        next_num = self._split_virtual_sku(sku)[1] + 1
+                else:
+                    start = self._split_virtual_sku(
+                        self.get_newest_virtual_sku(self._format_virtual_sku(prefix, num, width), live=True)
+                        )[1]
+                    vir_skus = [self._format_virtual_sku(prefix, i, width) for i in range(start, start + n)]
+                # 上传前逐个精确确认编号未被使用
+                with ThreadPoolExecutor(max_workers=10) as executor:
+                    exists = list(executor.map(
+                        bind_span(lambda sku: self.exist_virtual_sku(sku, ProductSearchOperate.EQUAL, live=True)),
+                        vir_skus
+                        ))
+                used = [sku for sku, exist in zip(vir_skus, exists) if exist]
+                if not used:
+                    break
+                logger.warning('待分配的虚拟sku中已有使用的编号%s, 重新查找', used)
+                if not gap_fill:
+                    # 从已用的最大编号之后重新查找
+                    num = self._split_virtual_sku(used[-1])[1] + 1
+
+            mb_sku_map_list = list(zip(mb_skus, vir_skus))
+            self.upload_virtual_sku(mb_sku_map_list)
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                mapped_skus = list(executor.map(bind_span(self._get_virtual_sku_mb_sku), vir_skus))
+        mismatched = {
+            vir_sku: (mb_sku, mapped_sku)
+            for (mb_sku, vir_sku), mapped_sku in zip(mb_sku_map_list, mapped_skus)
+            if mapped_sku != mb_sku
+            }
+        if mismatched:
+            raise MBApiError(f'虚拟sku上传后对应的库存sku不一致, {{虚拟sku: (应对应的sku, 实际对应的sku)}}: {mismatched}')
+        return mb_sku_map_list
+
+    def _get_virtual_sku_mb_sku(self, vir_sku):
+        '''虚拟sku对应的库存sku, 不存在或对应多个库存sku时返回None'''
+        try:
+            return self.get_product_info_from_virtual_sku(
+                vir_sku, ProductSearchOperate.EQUAL, error=False, live=True
+                ).sku
+        except ProductMultiError:
+            return None
 
     def upload_image(self, img_fp):
         '''上传图片
@@ -259,14 +507,14 @@ class MBApi(ProductApi, BiaoJuApi):
         :return: 上传后图片url
         '''
         if isinstance(img_fp, str):
-            img_f = open(img_fp, 'rb')
-        else:
-            img_f = img_fp
+            with open(img_fp, 'rb') as img_f:
+                return self.upload_image(img_f)
         api = API_MAP['upload_image']
-        files = {'UpLoadFile': ('test.jpg', img_f, 'image/jpeg')}
-        data = {'postName': 'UpLoadFile'}
-        r = requests.post(api, data=data, files=files)
-        logger.debug('%s: %s' % (r.status_code, r.text))
+        body = MultipartEncoder(
+            [('postName', 'UpLoadFile')], [('UpLoadFile', 'test.jpg', img_fp, 'image/jpeg')]
+            )
+        r = requests.post(api, data=body, headers={'Content-Type': body.content_type})
+        self.log_policy.log_response(logger, '上传图片', r)
         return r.json()['imageUrl']
 
     def get_profit_info(self, shopname, start_date, end_date):
@@ -333,6 +581,7 @@ class MBApi(ProductApi, BiaoJuApi):
         raw_json_data = re.search(r'(?<=>){.*}(?=<)', pos_html).group()
         return json.loads(raw_json_data)
 
+    @traced
     def get_mb_order_id(self, order_id):
         '''获取订单的马帮内部id
         :param order_id: 订单编号
@@ -347,30 +596,31 @@ class MBApi(ProductApi, BiaoJuApi):
             'tableBase': 2,
             'lang': 'cn',
             }
-        html_text = self.r_session.get(api, params=params).text
+        html_text = self._session_request('get', api, params=params).text
         mb_order_id = re.search(r'(?<=&orderId=)\d+', html_text).group()
         return int(mb_order_id)
 
+    @traced
     def get_order_op_log(self, mb_order_id):
         '''获取订单的操作日志
         :return: 操作日志字典列表，默认排序为mb返回的排序，即时间倒序.
             格式: [{'操作属性': x, '描述': x, '操作员': x, '操作时间': x, '其他信息': {}}]
         '''
-        def handle_tr(tr):
+        def handle_row(row):
+            op_type, detail, operator, op_time, links = row
             data = {}
-            op_type = tr.xpath('./td[1]/text()')[0]
             data['op_type'] = op_type
-            data['detail'] = ''.join(tr.xpath('./td[2]//text()'))
-            data['operator'] = tr.xpath('./td[3]/text()')[0]
-            data['op_time'] = tr.xpath('./td[4]/text()')[0]
+            data['detail'] = detail
+            data['operator'] = operator
+            data['op_time'] = op_time
             data['ext'] = {}
             if op_type == ORDER_OP_TYPE_MAP['合并订单']:
                 # 是否未合并订单的主订单号
                 if '合并到订单' in data['detail']:
-                    data['ext']['order_id'] = tr.xpath('./td[2]/a/text()')[0]
+                    data['ext']['order_id'] = links[0]
                     data['ext']['is_main'] = False
                 else:
-                    data['ext']['order_id'] = tr.xpath('./td[2]/a/text()')
+                    data['ext']['order_id'] = links
                     data['ext']['is_main'] = True
             return data
 
@@ -383,16 +633,21 @@ class MBApi(ProductApi, BiaoJuApi):
             }
         ret_data = self.request('post', api, data=data)
         html_text = ret_data['message']
-        tree = html.fromstring(html_text)
         return [
-            handle_tr(tr)
-            for tr in tree.xpath('//tr')
+            handle_row(row)
+            for row in parse_op_log_rows(html_text)
             ]
 
     def get_order(self, order_id: str):
         '''搜索订单'''
         api = API_MAP['search_order']
-        data = {
+        data = self._make_order_search_data(order_id)
+        ret_data = self.request('post', api, data=data)
+        return self._select_order(ret_data['orderDataList'], order_id)
+
+    @staticmethod
+    def _make_order_search_data(order_id: str):
+        return {
             'OrderSearch.fuzzySearchKey': 'Order.platformOrderId',
             'OrderSearchFuSKey': 'a.platformOrderId',
             'daysOperator': '=',
@@ -401,8 +656,9 @@ class MBApi(ProductApi, BiaoJuApi):
             'a': 'orderalllist',
             'post_tableBase': 1,
             }
-        ret_data = self.request('post', api, data=data)
-        order_list = ret_data['orderDataList']
+
+    @staticmethod
+    def _select_order(order_list, order_id):
         if not order_list:
             raise MBApiError(f'{order_id} 查无该订单')
         if len(order_list) > 1:
@@ -413,28 +669,70 @@ class MBApi(ProductApi, BiaoJuApi):
         '''获取订单物流信息'''
         order = self.get_order(order_id)
         logistics_html = order['cansend1logisticsHtml']
-        tree = html.fromstring(logistics_html)
-        ship_serv = tree.xpath('./p[1]/text()')[0].strip()
+        ship_serv = parse_logistics_ship_serv(logistics_html)
         tracking_no = order['trackNumber']
         return {'ship_serv': ship_serv, 'tracking_no': tracking_no}
 
     def get_order_by_ids(self, order_ids: list):
         '''获取搜索多个订单信息'''
         api = API_MAP['search_order']
-        data = {
+        data = self._make_order_ids_search_data(order_ids)
+        return self.request('post', api, data=data)
+
+    def iter_orders_by_ids(self, order_ids: list, chunk_size=ORDER_SEARCH_CHUNK_SIZE, concurrency=5):
+        '''批量搜索订单, 订单id分块后并发搜索, 每块会读取所有分页
+        :param order_ids: 订单id列表
+        :param chunk_size: 每次搜索的订单id数量
+        :param concurrency: 最大并发请求数
+        :return: 订单数据的生成器, 按搜索完成的先后顺序返回
+        '''
+        order_ids = list(dict.fromkeys(order_ids))
+        chunks = [order_ids[i:i + chunk_size] for i in range(0, len(order_ids), chunk_size)]
+        executor = ThreadPoolExecutor(max_workers=concurrency)
+        futures = [executor.submit(bind_span(self._search_order_chunk), chunk) for chunk in chunks]
+        try:
+            for future in as_completed(futures):
+                yield from future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+
+    def _search_order_chunk(self, order_ids: list) -> list:
+        '''搜索一块订单id, 读取所有分页'''
+        api = API_MAP['search_order']
+        order_id_set = set(order_ids)
+        order_map = {}
+        page = 1
+        while True:
+            data = self._make_order_ids_search_data(order_ids)
+            data.update({'page': page, 'rowsPerPage': ORDER_SEARCH_PAGE_SIZE})
+            order_list = self.request('post', api, data=data)['orderDataList']
+            new_orders = [order for order in order_list if order['platformOrderId'] not in order_map]
+            for order in new_orders:
+                order_map[order['platformOrderId']] = order
+            # 没有新订单说明已是最后一页(或接口忽略了分页参数).
+            # rowsPerPage可能被接口忽略而使用更小的默认分页, 不能以返回数量少于每页数量判断最后一页
+            if not new_orders or order_id_set.issubset(order_map):
+                break
+            page += 1
+        return list(order_map.values())
+
+    @staticmethod
+    def _make_order_ids_search_data(order_ids: list):
+        return {
             'platformTracknumberSearchInput': 'platformOrderId',
             'platformTracknumberSearchtextarea': '\n'.join(order_ids)
             }
-        return self.request('post', api, data=data)
 
+    @traced
     def get_order_shipping_info_by_ids(self, order_ids: list) -> list:
         '''获取物流信息
+        被合并作废的订单返回其主订单的物流信息, 所有被合并订单的主订单只批量搜索一次
         :return: 返回格式[{order_id: x, shipping_service: x, tracking_no: x}]和不存在的订单id
         '''
-        def get_merge_order_shipping_info(order_id):
-            op_log = self.get_order_op_log(order_id)['message']
-            main_order_id = re.search(r'合并到订单<a[^>]+>(\w+)</a>', op_log).group(1)
-            return self.get_order_shipping_info(main_order_id)
+        def is_merged(order_data):
+            return order_data['showOrderStatusText'] == '已作废' and '合并订单' in order_data['order_label']
 
         def convert(order_data):
             no_shipping_keyword = [
@@ -443,9 +741,6 @@ class MBApi(ProductApi, BiaoJuApi):
                 ]
             order_id = order_data['platformOrderId']
             shipping_info = order_data['cansend1logisticsHtml']
-            if order_data['showOrderStatusText'] == '已作废' and '合并订单' in order_data['order_label']:
-                return get_merge_order_shipping_info(order_id)
-
             if any(kw in shipping_info for kw in no_shipping_keyword):
                 shipping_service = ''
                 tracking_no = ''
@@ -467,12 +762,52 @@ class MBApi(ProductApi, BiaoJuApi):
                 no_exist_ids = []
             return no_exist_ids
 
-        ret_data = self.get_order_by_ids(order_ids)
-        order_list = ret_data['orderDataList']
+        order_list = list(self.iter_orders_by_ids(order_ids))
         no_exist_ids = get_no_exist_ids(order_list, order_ids)
-        shipping_info_list = [convert(order) for order in order_list]
+
+        # 订单id -> 物流信息, 被合并订单 -> 主订单id
+        shipping_info_map = {}
+        main_order_id_map = {}
+        pending_orders = order_list
+        # 主订单也可能被合并到其他订单, 限制查找层数防止死循环.
+        # 第depth轮处理经过depth层合并得到的订单, 最后一轮只检查不再查找主订单
+        for depth in range(MERGE_ORDER_MAX_DEPTH + 1):
+            merged_ids = []
+            for order in pending_orders:
+                if is_merged(order):
+                    merged_ids.append(order['platformOrderId'])
+                else:
+                    shipping_info_map[order['platformOrderId']] = convert(order)
+            if not merged_ids:
+                break
+            if depth == MERGE_ORDER_MAX_DEPTH:
+                raise MBApiError(f'合并订单层数超过{MERGE_ORDER_MAX_DEPTH}层: {merged_ids}')
+            new_main_order_id_map = self._get_main_order_ids(merged_ids)
+            main_order_id_map.update(new_main_order_id_map)
+            main_order_ids = set(new_main_order_id_map.values()) - set(shipping_info_map)
+            pending_orders = list(self.iter_orders_by_ids(list(main_order_ids))) if main_order_ids else []
+
+        def get_shipping_info(order_id):
+            seen = set()
+            while order_id not in shipping_info_map:
+                if order_id in seen or order_id not in main_order_id_map:
+                    raise OrderNotExistError('订单不存在, 订单id:  %s', order_id)
+                seen.add(order_id)
+                order_id = main_order_id_map[order_id]
+            return shipping_info_map[order_id]
+
+        shipping_info_list = [get_shipping_info(order['platformOrderId']) for order in order_list]
         return shipping_info_list, no_exist_ids
 
+    def _get_main_order_ids(self, order_ids: list, max_workers=10) -> dict:
+        '''并发获取多个合并订单的主订单id
+        :return: {订单id: 主订单id}
+        '''
+        order_ids = list(dict.fromkeys(order_ids))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            main_order_ids = list(executor.map(bind_span(self.get_main_order_id), order_ids))
+        return dict(zip(order_ids, main_order_ids))
+
     def get_order_shipping_info(self, order_id):
         '''获取单订单的物流信息'''
         shipping_info_list, no_exist_ids = self.get_order_shipping_info_by_ids([order_id])
@@ -510,12 +845,13 @@ class MBApi(ProductApi, BiaoJuApi):
         :param fp: 文件对象，必须有name属性; 或文件路径
         '''
         if isinstance(fp, str):
-            fp = open(fp, 'rb')
+            with open(fp, 'rb') as f:
+                return self._upload_order_xlsx(f, template_id, shop_id)
         api = API_MAP['upload_order_xlsx']
-        file_content_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        files = {'templetfile': (fp.name, fp, file_content_type)}
-        data = {'templateId': template_id, 'shopId': shop_id}
-        resp = self.r_session.post(api, data=data, files=files)
+        data = [('templateId', template_id), ('shopId', shop_id)]
+        # 流式上传, 不把整个文件读入内存
+        body = MultipartEncoder(data, [('templetfile', os.path.basename(fp.name), fp, XLSX_CONTENT_TYPE)])
+        resp = self._session_request('post', api, data=body, headers={'Content-Type': body.content_type})
         if '"success":true' not in resp.text:
             raise MBApiError('订单文件上传失败，返回信息为: %s', resp.text)
         return resp.text
@@ -524,14 +860,111 @@ class MBApi(ProductApi, BiaoJuApi):
         '''上传5miles订单'''
         return self._upload_order_xlsx(fp, ORDER_UPLOAD_TEMPLATE_ID_MAP['5miles'], shop_id)
 
-    def export_order(self, order_ids: list, headers: list, template_id: int=0) -> list:
+    @traced
+    def export_order(self, order_ids: list, headers: list, template_id: int=0, output='list', path=None):
         '''导出订单信息
         :param order_ids: 订单id列表
         :param headers: 导出的字段列表
         :param: template_id: 导出订单由headers确定，目前template_id可不传入
-        :return: 返回订单列表
+        :param output: 输出方式, list: 订单列表; arrow: pyarrow.Table; parquet/csv: 写入path
+        :param path: parquet/csv输出的文件路径
+        :return: 返回订单列表, pyarrow.Table或输出的文件路径
         '''
         assert order_ids
+        if output != 'list':
+            # 流式读取表格后直接按列转换, 不经过pandas
+            return convert_rows(self.iter_export_order(order_ids, headers, template_id), headers, output, path)
+        url = self._get_export_order_url(order_ids, headers, template_id)
+        content = self._session_request('get', url).content
+        df = pd.read_excel(io.BytesIO(content), na_filter=False)
+        ret_data = df.values.tolist()
+        if len(ret_data) != len(order_ids):
+            raise MBApiError(f'导出订单接口错误, 导出前后订单数量[{len(order_ids),len(ret_data)}]不一致')
+        return ret_data
+
+    @traced
+    def iter_export_order(self, order_ids: list, headers: list, template_id: int=0):
+        '''导出订单信息, 流式下载及读取表格, 内存占用与订单数量无关
+        参数见export_order
+        :return: 订单行的生成器, 每行为tuple, 空单元格为''
+        '''
+        assert order_ids
+        url = self._get_export_order_url(order_ids, headers, template_id)
+        with tempfile.TemporaryFile() as fp:
+            # 下载及读取出错统一抛出MBApiRequestError, 便于调用方重试
+            try:
+                r = self._session_request('get', url, stream=True)
+            except requests.exceptions.RequestException as e:
+                raise MBApiRequestError('下载导出订单表格出错', e)
+            try:
+                if r.status_code != 200:
+                    raise MBApiRequestError('下载导出订单表格出错, 返回状态码为: %s' % r.status_code)
+                for chunk in r.iter_content(chunk_size=EXPORT_DOWNLOAD_CHUNK_SIZE):
+                    fp.write(chunk)
+            except requests.exceptions.RequestException as e:
+                raise MBApiRequestError('下载导出订单表格出错', e)
+            finally:
+                r.close()
+            fp.seek(0)
+            try:
+                wb = load_workbook(fp, read_only=True)
+            except (zipfile.BadZipFile, InvalidFileException) as e:
+                raise MBApiRequestError('下载的导出订单表格无效', e)
+            try:
+                rows = wb.active.iter_rows(values_only=True)
+                # 跳过表头
+                next(rows, None)
+                row_count = 0
+                for row in rows:
+                    row_count += 1
+                    yield tuple('' if value is None else value for value in row)
+            finally:
+                wb.close()
+        if row_count != len(order_ids):
+            raise MBApiError(f'导出订单接口错误, 导出前后订单数量[{len(order_ids),row_count}]不一致')
+
+    @traced
+    def export_order_in_chunks(
+        self, order_ids: list, headers: list, template_id: int=0,
+        chunk_size=EXPORT_CHUNK_SIZE, max_workers=4, retries=2,
+    ) -> list:
+        '''分块并发导出订单信息, 适用于大量订单
+        每块单独导出及校验订单数量, 出错的块单独重试
+        :param chunk_size: 每块的订单数量
+        :param max_workers: 最大并发导出数
+        :param retries: 出错的块最多重试次数
+        :return: 订单行列表, 顺序与order_ids的分块顺序一致
+        '''
+        assert order_ids
+        chunks = [order_ids[i:i + chunk_size] for i in range(0, len(order_ids), chunk_size)]
+
+        def export(chunk):
+            return list(self.iter_export_order(chunk, headers, template_id))
+
+        results = [None] * len(chunks)
+        errors = {}
+        pending = list(range(len(chunks)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for attempt in range(retries + 1):
+                futures = {index: executor.submit(bind_span(export), chunks[index]) for index in pending}
+                pending = []
+                for index, future in futures.items():
+                    try:
+                        results[index] = future.result()
+                    except MBApiError as e:
+                        logger.warning('导出第%s块订单失败(第%s次): %s', index, attempt + 1, e)
+                        errors[index] = e
+                        pending.append(index)
+                if not pending:
+                    break
+        if pending:
+            raise MBApiError(
+                '导出订单失败的分块: %s' % {index: (chunks[index][0], errors[index]) for index in pending}
+                )
+        return [row for rows in results for row in rows]
+
+    def _get_export_order_url(self, order_ids: list, headers: list, template_id: int=0) -> str:
+        '''生成导出订单表格, 返回表格的下载地址'''
         api = API_MAP['download_order_xlsx']
         data = [
             ('backUrl', ''),
@@ -556,20 +989,17 @@ class MBApi(ProductApi, BiaoJuApi):
             ('mergeShow', 1),
             ('hbddgyxx', 2),
             ])
-        url = self.request('post', api, data=data)['gourl']
-        content = self.r_session.get(url).content
-        df = pd.read_excel(io.BytesIO(content), na_filter=False)
-        ret_data = df.values.tolist()
-        if len(ret_data) != len(order_ids):
-            raise MBApiError(f'导出订单接口错误, 导出前后订单数量[{len(order_ids),len(ret_data)}]不一致')
-        return ret_data
+        return self.request('post', api, data=data)['gourl']
 
-    def download_order_xlsx_for_5miles(self, order_ids: list) -> list:
+    @traced
+    def download_order_xlsx_for_5miles(self, order_ids: list, output='list', path=None):
         '''下载5miles订单表格
         注意:
             一般情况下，导打算导出的订单数据等于出的实际订单数量.
             如果存在该批次订单与之前批次订单合并的话，则后者大于前者
-        :return: 订单数据列表
+        :param output: 输出方式, 见export_order
+        :param path: parquet/csv输出的文件路径
+        :return: 订单数据列表, 每行为(交易编号, 平台SKU, 5miles物流代码, 商品数量, 货运单号)
         '''
         def convert_shipping_service(name):
             '''转换物流编号
@@ -626,7 +1056,7 @@ class MBApi(ProductApi, BiaoJuApi):
         status_index = 6
         # 被合并订单会生成多列
         merge_order_index = 7
-        order_list = self.export_order(order_ids, headers)
+        order_list = self.export_order_in_chunks(order_ids, headers)
         # 已处理的订单，对于合并的订单，防止订单重复处理
         # 无物流信息订单
         no_info_rows = []
@@ -666,14 +1096,17 @@ class MBApi(ProductApi, BiaoJuApi):
             raise MBApiError(log)
 
         # 获取作废的订单的物流信息
-        for row in invalid_rows:
+        if invalid_rows:
             # WARNING: 5miles订单编号与交易编号一致，这里使用的是交易编号
-            order_id = row[order_id_index]
-            logger.info(f'{order_id} 尝试获取合并订单的主订单号的物流信息')
-            # 获取合并订单的主订单编号
-            main_order_id = self.get_main_order_id(order_id)
-            main_order_row = self.export_order([main_order_id], headers)[0]
-            valid_rows.append(main_order_row)
+            invalid_order_ids = [row[order_id_index] for row in invalid_rows]
+            logger.info('%s 尝试获取合并订单的主订单号的物流信息', invalid_order_ids)
+            # 并发获取合并订单的主订单编号, 去重后一次导出所有主订单
+            main_order_ids = list(dict.fromkeys(self._get_main_order_ids(invalid_order_ids).values()))
+            # 主订单已在本批次中的无需再导出
+            valid_order_ids = set(row[order_id_index] for row in valid_rows)
+            main_order_ids = [order_id for order_id in main_order_ids if order_id not in valid_order_ids]
+            if main_order_ids:
+                valid_rows.extend(self.iter_export_order(main_order_ids, headers))
 
         for row in valid_rows:
             order_id_list, sku_list, quantity_list = unfold(row)
@@ -698,8 +1131,11 @@ class MBApi(ProductApi, BiaoJuApi):
                 '导出订单前后不一致, 少了订单为[%s], 多了订单为[%s]'
                 % (order_id_set-export_order_id_set, export_order_id_set-order_id_set)
                 )
+        if output != 'list':
+            return convert_rows(ret_data, ['交易编号', '平台SKU', '物流渠道', '商品数量', '货运单号'], output, path)
         return ret_data
 
+    @traced
     def get_main_order_id(self, order_id):
         '''获取合并订单的主id'''
         mb_order_id = self.get_mb_order_id(order_id)
@@ -726,23 +1162,17 @@ class MBApi(ProductApi, BiaoJuApi):
             }
         ret_data = self.request('post', api, data=data)
         order_html = ret_data['order_html']
-        tree = html.fromstring(order_html)
         ret_data = []
-        for tr in tree.xpath('//tr'):
-            # url = tr.xpath('./td[1]/a/@href')[0]
-            订单编号 = tr.xpath('./td[1]/a/text()')[0]
-            状态 = tr.xpath('./td[2]/text()')[0]
-            # 订单金额 = tr.xpath('./td[3]/text()')[0]
-            # 付款时间 = tr.xpath('./td[4]/p[0]/text()')[0]
-            发货时间 = tr.xpath('./td[4]/p[1]/text()')[0]
+        for 订单编号, 状态, 发货时间 in parse_related_order_rows(order_html):
             ret_data.append({'订单编号': 订单编号})
         return ret_data
 
     def is_order_uploaded(self, filename):
         '''获取订单是否已成功上传'''
         api = API_MAP['get_upload_order_status']
-        return filename in self.r_session.get(api).text
+        return filename in self._session_request('get', api).text
 
+    @traced
     def get_order_upload_status(self, filename):
         '''获取某订单文件的上传状态'''
         OrderStatus = namedtuple('StatusStr', [
@@ -756,7 +1186,7 @@ class MBApi(ProductApi, BiaoJuApi):
             'log_url'
             ])
         api = API_MAP['get_upload_order_status']
-        text = self.r_session.get(api).text
+        text = self._session_request('get', api).text
         status_str_list = text.split('</tr>')
         for status_str in status_str_list:
             if filename in status_str:
@@ -0,0 +1,312 @@
+"""
+基于asyncio的马帮接口客户端
+
+用法:
+    async with AsyncMBApi(user, passwd, business_number, user_id) as api:
+        orders = await asyncio.gather(*(api.get_order(i) for i in order_ids))
+"""
+import asyncio
+import json
+import time
+import logging
+from datetime import datetime
+
+import aiohttp
+
+from . import API_MAP, MBApi
+from .base import LOGIN_EXPIRE
+from .biaoju import BiaoJuApi
+from .constant import AAMZ_API, BIAOJU_API
+from .log_policy import LogPolicy
+from .exceptions import (
+    MBApiRequestError,
+    MBApiBizError,
+    LoginError,
+)
+from .product import (
+    ProductApi,
+    ProductSearchOperate,
+    ProductSearchType,
+    StockProductSearchKey,
+    ComboProductSearchKey,
+    Product,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMBApi():
+    """异步版MBApi, 接口与MBApi保持一致, 所有接口均为协程
+    :param limit_per_host: 每个域名的最大并发连接数
+    :param log_policy: 请求日志策略, 见mbapi.log_policy.LogPolicy
+    """
+    def __init__(
+        self, user, passwd, business_number, user_id, limit_per_host=20, timeout=60, log_policy=None,
+    ):
+        self.user = user
+        self.passwd = passwd
+        self.business_number = business_number
+        self.user_id = user_id
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.log_policy = log_policy or LogPolicy()
+        self.login_error_times = 0
+        self._session = None
+        self._datetime = None
+        self._login_lock = None
+        self._login_generation = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _make_session(self):
+        connector = aiohttp.TCPConnector(limit_per_host=self.limit_per_host)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    @property
+    def _raw_session(self):
+        if self._session is None:
+            self._session = self._make_session()
+        return self._session
+
+    async def session(self):
+        """获取已登录的session, 与MBApiBase.r_session一致, 每LOGIN_EXPIRE检测一次登录状态"""
+        if self._datetime is None or datetime.now() - self._datetime > LOGIN_EXPIRE:
+            async with self._get_login_lock():
+                if self._datetime is None or datetime.now() - self._datetime > LOGIN_EXPIRE:
+                    await self._check_login()
+                    self._datetime = datetime.now()
+        return self._raw_session
+
+    def _get_login_lock(self):
+        if self._login_lock is None:
+            self._login_lock = asyncio.Lock()
+        return self._login_lock
+
+    async def _relogin(self, generation):
+        """重新登录, 多个协程同时发现登录失效时只登录一次"""
+        async with self._get_login_lock():
+            if self._login_generation != generation:
+                return
+            await self.login()
+
+    def start_keepalive(self, interval=30, margin=60):
+        """启动后台协程, 在登录状态过期前margin秒重新检测登录状态, 必要时重新登录
+        :return: asyncio.Task, 取消该task即停止
+        """
+        async def keepalive():
+            while True:
+                await asyncio.sleep(interval)
+                if self._datetime is not None and (
+                    datetime.now() - self._datetime
+                ).total_seconds() < LOGIN_EXPIRE.total_seconds() - margin:
+                    continue
+                start = time.monotonic()
+                try:
+                    async with self._get_login_lock():
+                        await self._check_login()
+                        self._datetime = datetime.now()
+                except Exception as e:
+                    logger.exception('%s 刷新登录状态失败, 耗时%.2f秒: %s', self.user, time.monotonic() - start, e)
+                else:
+                    logger.info('%s 刷新登录状态完成, 耗时%.2f秒', self.user, time.monotonic() - start)
+        return asyncio.ensure_future(keepalive())
+
+    async def request(self, method, url, login_for_error=True, **kw):
+        self.log_policy.log_request(logger, method, url, kw)
+        headers = {'X-Requested-With': 'XMLHttpRequest'}
+        headers.update(kw.get('headers', {}))
+        new_kw = {k: v for k, v in kw.items() if k != 'headers'}
+        try:
+            session = await self.session()
+            login_generation = self._login_generation
+            async with session.request(method, url, headers=headers, **new_kw) as r:
+                status = r.status
+                text = await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MBApiRequestError('mb无法访问', e)
+        self.log_policy.log_response(logger, 'mb', text)
+        if status != 200:
+            raise MBApiRequestError('请求mb接口出错, 返回状态码为: %s', status)
+        try:
+            ret_data = json.loads(text)
+        except json.JSONDecodeError as e:
+            raise MBApiRequestError('返回非json数据: %s', text)
+        if not ret_data['success']:
+            if login_for_error and MBApi._check_login_invalid(ret_data["message"]):
+                logger.info(f"登录信息超时，重新登录")
+                await self._relogin(login_generation)
+                return await self.request(method, url, login_for_error=False, **kw)
+            raise MBApiBizError('请求mb接口出错, 返回数据为: %s', ret_data)
+        if ret_data.get("errorMessage"):
+            raise MBApiBizError("调用mb接口成功，但出现错误: %s" % ret_data["errorMessage"])
+        return ret_data
+
+    async def _get_text(self, url, **kw):
+        try:
+            async with self._raw_session.get(url, **kw) as r:
+                return await r.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MBApiRequestError('mb无法访问', e)
+
+    async def _get_json(self, url, **kw):
+        try:
+            async with self._raw_session.get(url, **kw) as r:
+                return await r.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MBApiRequestError('mb无法访问', e)
+
+    async def _check_login(self):
+        aamz_text, mb_text, votobo_json = await asyncio.gather(
+            self._get_text(AAMZ_API),
+            self._get_text(API_MAP['index']),
+            self._get_json(API_MAP['votobo_check_login']),
+        )
+        # 登录标记
+        login_flag = '企业编号'
+        if login_flag in mb_text and login_flag in aamz_text and votobo_json['success']:
+            logger.info('%s 登陆状态正常', self.user)
+            self.login_error_times = 0
+        else:
+            self.login_error_times += 1
+            if self.login_error_times < 3:
+                return await self.login()
+            raise LoginError("MB登录失败")
+
+    async def login(self):
+        logger.info('登陆mb: %s' % self.user)
+        session = self._raw_session
+        data = {'username': self.user, 'password': self.passwd}
+        try:
+            async with session.post(API_MAP['login'], data=data) as r:
+                r_json = await r.json(content_type=None)
+                cookie = r.cookies.get("MABANG_ERP_PRO_MEMBERINFO_LOGIN_COOKIE")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise MBApiRequestError('mb无法访问', e)
+        self.log_policy.log_response(logger, '登录', r_json)
+        if not r_json['success'] or cookie is None:
+            raise LoginError('MB登录失败')
+        c_mkey = cookie.value
+
+        await asyncio.gather(
+            self._login_aamz(c_mkey),
+            self._login_votobo(),
+            self._login_biaoju(),
+        )
+        self._login_generation += 1
+        await self._check_login()
+        self._datetime = datetime.now()
+
+    async def _login_aamz(self, c_mkey):
+        # 为AAMZ_API注册好Cookie
+        aamz_params = {
+            'mod': 'stock.list',
+            'searchStatus': 3,
+            'cMKey': c_mkey,
+            'lang': 'cn',
+            }
+        resp_text = await self._get_text(AAMZ_API, params=aamz_params)
+        self.log_policy.log_response(logger, '登录AAMZ', resp_text)
+
+    async def _login_votobo(self):
+        votobo_params = {
+            "mod": "vmain.mbLogin",
+            "mbkey": f"md_MABANG_ERP_PRIVATE_LOGIN_{self.business_number}_{self.user_id}_M0010806",
+            "private_mabang": "",
+        }
+        resp_json = await self._get_json(API_MAP['votobo_login'], params=votobo_params)
+        self.log_policy.log_response(logger, '登录votobo', resp_json)
+
+    async def _login_biaoju(self):
+        resp_text = await self._get_text(API_MAP['biaoju_login'])
+        self.log_policy.log_response(logger, '登陆镖局', resp_text)
+
+    async def get_order(self, order_id: str):
+        '''搜索订单'''
+        data = MBApi._make_order_search_data(order_id)
+        ret_data = await self.request('post', API_MAP['search_order'], data=data)
+        return MBApi._select_order(ret_data['orderDataList'], order_id)
+
+    async def get_order_by_ids(self, order_ids: list):
+        '''获取搜索多个订单信息'''
+        data = MBApi._make_order_ids_search_data(order_ids)
+        return await self.request('post', API_MAP['search_order'], data=data)
+
+    async def get_stock_sku_info_list(self, search_key, search_content, operate) -> list:
+        '''获取库存SKU商品数据'''
+        params = {"mod": "stock.getStockList"}
+        data = ProductApi._make_stock_list_data(search_key, search_content, operate)
+        r_data = await self.request('post', AAMZ_API, data=data, params=params)
+        return [Product.from_api(stock_data) for stock_data in r_data.get('stockData', [])]
+
+    async def get_combo_sku_info_list(self, search_key, search_content, operate) -> list:
+        '''获取组合SKU商品数据'''
+        params = {"mod": "combosku.getCombosSkuList"}
+        data = {
+            'searchLike': search_key,
+            'searchKeywords': search_content,
+            'operate': operate,
+        }
+        r_data = await self.request('post', AAMZ_API, data=data, params=params)
+        return ProductApi._parse_combo_sku_html(r_data["message"])
+
+    async def get_product_info(
+        self, search_key,
+        search_content: str, operate: ProductSearchOperate,
+        error=True,
+        search_type: ProductSearchType = ProductSearchType.STOCK_SKU_TYPE,
+    ):
+        """查询产品信息, 参数见ProductApi.get_product_info"""
+        if search_type == ProductSearchType.STOCK_SKU_TYPE:
+            operate = ProductApi._get_search_operater(search_type, operate)
+            product_list = await self.get_stock_sku_info_list(search_key, search_content, operate)
+        elif search_type == ProductSearchType.COMBO_SKU_TYPE:
+            operate = ProductApi._get_search_operater(search_type, operate)
+            product_list = await self.get_combo_sku_info_list(search_key, search_content, operate)
+        else:
+            raise ValueError(f"search_type: {search_type} 错误")
+        return ProductApi._select_product(product_list, search_key, search_content, error)
+
+    async def get_product_info_from_stock_sku(self, sku, operate=ProductSearchOperate.LIKE_START, error=True):
+        if sku.startswith("ZH"):
+            search_type = ProductSearchType.COMBO_SKU_TYPE
+            search_key = ComboProductSearchKey.COMBO_SKU
+        else:
+            search_type = ProductSearchType.STOCK_SKU_TYPE
+            search_key = StockProductSearchKey.STOCK_SKU
+        return await self.get_product_info(search_key, sku, operate, error=error, search_type=search_type)
+
+    async def get_product_info_from_virtual_sku(self, sku, operate=ProductSearchOperate.LIKE_START, error=True):
+        search_type = ProductSearchType.STOCK_SKU_TYPE
+        search_key = StockProductSearchKey.VIRTUAL_SKU
+        return await self.get_product_info(search_key, sku, operate, error=error, search_type=search_type)
+
+    async def get_shipping_fee(self, shipping_fee_id, weight, country="US", postal_code=""):
+        """获取单个国家物流价格, 参数见BiaoJuApi.get_shipping_fee"""
+        params = {
+            "m": "customshippingfee",
+            "a": "doCalculate",
+        }
+        data = BiaoJuApi._make_shipping_fee_data(shipping_fee_id, weight, country, postal_code)
+        r_data = await self.request('post', BIAOJU_API, data=data, params=params)
+        return BiaoJuApi._parse_shipping_fee(r_data, shipping_fee_id, weight, country)
+
+    async def get_dev_product_detail(self, dev_product_id: int):
+        """获取待开发商品的详情
+        :param dev_product_id: 待开发商品的id
+        """
+        params = {
+            "mod": "productApi.getProductDetail",
+            "productId": dev_product_id,
+        }
+        return await self.request('get', API_MAP['votobo_api'], params=params)
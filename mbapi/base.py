@@ -1,23 +1,66 @@
+import threading
 from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from .constant import (
+    MB_BASE_URL,
+    AAMZ_BASE_URL,
+    VOTOBO_BASE_URL,
+    BIAOJU_BASE_URL,
+)
+from .metrics import MetricsRegistry
+from .log_policy import LogPolicy
+from .tracing import Tracer
+
 
 LOGIN_EXPIRE = timedelta(minutes=10)
 
+# 登录域: 域名 -> 登录域名称
+LOGIN_DOMAIN_MAP = {
+    urlparse(MB_BASE_URL).netloc: 'mb',
+    urlparse(AAMZ_BASE_URL).netloc: 'aamz',
+    urlparse(VOTOBO_BASE_URL).netloc: 'votobo',
+    urlparse(BIAOJU_BASE_URL).netloc: 'biaoju',
+}
+# 可检测登录状态的登录域, 镖局没有检测接口, 依赖请求返回的"请重新登录"重新登录
+LOGIN_CHECK_DOMAINS = ('mb', 'aamz', 'votobo')
+
 
 class MBApiBase():
-    def __init__(self, user, passwd, business_number, user_id):
+    def __init__(
+        self, user, passwd, business_number, user_id,
+        product_cache=None, product_index=None, session_store=None, log_policy=None,
+    ):
+        """
+        :param product_cache: 商品查询缓存, 如mbapi.cache.ProductCache, 为None时不缓存
+        :param product_index: 本地商品索引, 如mbapi.product_index.ProductIndex
+        :param session_store: 登录session存储, 如mbapi.session_store.SessionStore, 启动时从中加载登录状态
+        :param log_policy: 请求日志策略, 见mbapi.log_policy.LogPolicy
+        """
         self._r_session = self._make_request_session()
         self.user = user
         self.passwd = passwd
         self.business_number = business_number
         self.user_id = user_id
-        self._datetime = None
+        # 各登录域最近一次确认登录有效的时间
+        self._login_datetimes = {}
         self.login_error_times = 0
+        # 登录及登录检测锁, 同一实例同一时刻只有一个线程在登录
+        self._login_lock = threading.RLock()
+        # 登录代数, 每次登录成功加1, 用于判断其他线程是否已重新登录
+        self._login_generation = 0
+        self.product_cache = product_cache
+        self.product_index = product_index
+        self.session_store = session_store
+        self.metrics = MetricsRegistry()
+        self.tracer = Tracer()
+        self.log_policy = log_policy or LogPolicy()
+        self._load_session()
 
     def _make_request_session(self):
         r_session = requests.Session()
@@ -27,14 +70,77 @@ class MBApiBase():
         r_session.mount("https://", http_adapter)
         return r_session
 
+    def _load_session(self):
+        """从session_store加载cookie及登录状态"""
+        if self.session_store is None:
+            return
+        item = self.session_store.load(self.session_store.make_key(self.user, self.business_number))
+        if item is None:
+            return
+        cookies, login_timestamps = item
+        for cookie in cookies:
+            self._r_session.cookies.set_cookie(cookie)
+        self._login_datetimes.update(
+            (domain, datetime.fromtimestamp(timestamp)) for domain, timestamp in login_timestamps.items()
+        )
+
+    def _save_session(self):
+        """保存cookie及登录状态到session_store"""
+        if self.session_store is None:
+            return
+        self.session_store.save(
+            self.session_store.make_key(self.user, self.business_number),
+            self._r_session.cookies,
+            {domain: dt.timestamp() for domain, dt in self._login_datetimes.items()},
+        )
+
     @property
     def r_session(self):
-        if self._datetime is None or datetime.now() - self._datetime > LOGIN_EXPIRE:
-            self._check_login()
-        self._datetime = datetime.now()
+        """检测所有登录域的登录状态后返回session"""
+        return self._get_session()
+
+    def _get_session(self, url=None):
+        """获取session, 只检测url所属登录域的登录状态, 每个登录域每LOGIN_EXPIRE检测一次
+        :param url: 将要请求的url, 为None时检测所有登录域
+        """
+        if url is None:
+            domains = LOGIN_CHECK_DOMAINS
+        else:
+            domain = self._get_login_domain(url)
+            domains = (domain,) if domain in LOGIN_CHECK_DOMAINS else ()
+        if self._get_expired_domains(domains):
+            with self._login_lock:
+                # 等待锁期间其他线程可能已完成检测
+                expired_domains = self._get_expired_domains(domains)
+                if expired_domains:
+                    self._check_login(expired_domains)
+        now = datetime.now()
+        for domain in domains:
+            self._login_datetimes[domain] = now
         return self._r_session
 
-    def _check_login_invalid(self, message):
+    def _get_expired_domains(self, domains):
+        now = datetime.now()
+        return [
+            domain for domain in domains
+            if domain not in self._login_datetimes or now - self._login_datetimes[domain] > LOGIN_EXPIRE
+        ]
+
+    def _relogin(self, generation):
+        """重新登录, 多个线程同时发现登录失效时只有一个线程登录, 其他线程等待其完成后直接返回
+        :param generation: 调用方发起请求时的登录代数
+        """
+        with self._login_lock:
+            if self._login_generation != generation:
+                return
+            self.login()
+
+    @staticmethod
+    def _get_login_domain(url):
+        return LOGIN_DOMAIN_MAP.get(urlparse(url).netloc)
+
+    @staticmethod
+    def _check_login_invalid(message):
         """
         "登录信息已超时"为马帮接口登录失效返回信息
         "请重新登录"为镖局接口登录失效返回信息
@@ -42,7 +148,10 @@ class MBApiBase():
         words = ["登录信息已超时", "请重新登录"]
         return any(word in message for word in words)
 
-    def _check_login(self):
+    def _check_login(self, domains=LOGIN_CHECK_DOMAINS):
+        raise NotImplementedError
+
+    def login(self):
         raise NotImplementedError
 
     def request(self, url, method, **kw):
@@ -1,14 +1,28 @@
 """
 镖局接口
 """
-from lxml import html
+import re
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from .base import MBApiBase
 from .constant import (
     BIAOJU_API
 )
 from .config import COMMON_SHIPPING_FEE_ID, SPECIAL_SHIPPING_FEE_ID
-from .exceptions import CalculateShippingFeeError
+from .exceptions import MBApiError, CalculateShippingFeeError
+from .tracing import traced, bind_span
+from .parsing import parse_shipping_fee_detail_rows, parse_first_shipping_fee
+
+
+logger = logging.getLogger(__name__)
+
+# doCalculate单次请求最多携带的查询行数
+SHIPPING_FEE_BATCH_SIZE = 50
+
+# 批量查询运费的结果, fee和error有且只有一个不为None
+ShippingFeeResult = namedtuple('ShippingFeeResult', 'shipping_fee_id weight country postal_code fee error')
 
 
 class BiaoJuApi(MBApiBase):
@@ -24,16 +38,139 @@ class BiaoJuApi(MBApiBase):
             "m": "customshippingfee",
             "a": "doCalculate",
         }
+        data = self._make_shipping_fee_data(shipping_fee_id, weight, country, postal_code)
+        r_data = self.request('post', api, data=data, params=params)
+        return self._parse_shipping_fee(r_data, shipping_fee_id, weight, country)
+
+    def get_shipping_fee_batch(self, shipping_fee_id, items, batch_size=SHIPPING_FEE_BATCH_SIZE) -> list:
+        """单个请求获取多行物流价格
+        多行查询合并到一个doCalculate请求中, 每batch_size行一个请求.
+        返回的每一行需与对应查询行的国家及重量一致, 否则该批次退回逐个查询.
+        :param shipping_fee_id: 物流自定义费用id
+        :param items: (weight, country, postal_code)列表, postal_code可省略
+        :return: 与items顺序一致的(fee, error)列表
+        """
+        items = [(weight, country, str(rest[0]) if rest else "") for weight, country, *rest in items]
+        ret_list = []
+        for start in range(0, len(items), batch_size):
+            ret_list.extend(self._get_shipping_fee_chunk(shipping_fee_id, items[start:start + batch_size]))
+        return ret_list
+
+    def _get_shipping_fee_chunk(self, shipping_fee_id, items):
+        def quote_one_by_one():
+            ret_list = []
+            for weight, country, postal_code in items:
+                try:
+                    ret_list.append((self.get_shipping_fee(shipping_fee_id, weight, country, postal_code), None))
+                except MBApiError as e:
+                    ret_list.append((None, e))
+            return ret_list
+
+        if len(items) == 1:
+            return quote_one_by_one()
+        api = BIAOJU_API
+        params = {
+            "m": "customshippingfee",
+            "a": "doCalculate",
+        }
         data = {
+            "data": "\n".join(
+                "||".join([country, str(weight), postal_code])
+                for weight, country, postal_code in items
+            ),
+            "ruleId": shipping_fee_id,
+            "type": 1,
+        }
+        try:
+            r_data = self.request('post', api, data=data, params=params)
+            rows = parse_shipping_fee_detail_rows(r_data["calculationRetHtml"])
+        except (MBApiError, KeyError):
+            rows = []
+        if len(rows) != len(items):
+            logger.warning('批量计算物流返回%s行, 与查询行数%s不一致, 改为逐个查询', len(rows), len(items))
+            return quote_one_by_one()
+        ret_list = []
+        for (weight, country, _), (cells, price) in zip(items, rows):
+            fee = self._match_shipping_fee_row(cells, price, weight, country)
+            if fee is None:
+                logger.warning('批量计算物流返回的行%s与查询[%s, %s]不对应, 改为逐个查询', cells, country, weight)
+                return quote_one_by_one()
+            ret_list.append((fee, None))
+        return ret_list
+
+    @staticmethod
+    def _match_shipping_fee_row(cells, price, weight, country):
+        """返回行的单元格中同时包含查询的国家及重量时返回价格, 否则返回None"""
+        if price is None:
+            return None
+        country_re = re.compile(r'(?<![A-Za-z])%s(?![A-Za-z])' % re.escape(str(country)), re.I)
+        if not any(country_re.search(cell) for cell in cells):
+            return None
+        numbers = [float(number) for cell in cells for number in re.findall(r'\d+(?:\.\d+)?', cell)]
+        if not any(abs(number - float(weight)) < 1e-6 for number in numbers):
+            return None
+        try:
+            return float(price)
+        except ValueError:
+            return None
+
+    @traced
+    def get_shipping_fees(self, fee_requests, max_workers=10, batch=False) -> list:
+        """批量获取物流价格, 相同的查询只请求一次, 单个查询出错不影响其他查询
+        :param fee_requests: (shipping_fee_id, weight, country, postal_code)的可迭代对象, postal_code可省略
+        :param max_workers: 最大并发请求数
+        :param batch: 是否将同一规则的多个查询合并到一个请求中, 见get_shipping_fee_batch
+        :return: 与输入顺序一致的ShippingFeeResult列表, 出错的查询fee为None, error为对应异常
+        """
+        keys = [self._normalize_fee_request(item) for item in fee_requests]
+        unique_keys = list(dict.fromkeys(keys))
+
+        if batch:
+            chunks = []
+            rule_keys_map = {}
+            for key in unique_keys:
+                rule_keys_map.setdefault(key[0], []).append(key)
+            for shipping_fee_id, rule_keys in rule_keys_map.items():
+                for start in range(0, len(rule_keys), SHIPPING_FEE_BATCH_SIZE):
+                    chunks.append(rule_keys[start:start + SHIPPING_FEE_BATCH_SIZE])
+
+            def quote(chunk):
+                return self._get_shipping_fee_chunk(chunk[0][0], [key[1:] for key in chunk])
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                quoted = {}
+                for chunk, results in zip(chunks, executor.map(bind_span(quote), chunks)):
+                    quoted.update(zip(chunk, results))
+        else:
+            def quote(key):
+                try:
+                    return self.get_shipping_fee(*key), None
+                except MBApiError as e:
+                    return None, e
+
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                quoted = dict(zip(unique_keys, executor.map(bind_span(quote), unique_keys)))
+        return [ShippingFeeResult(*key, *quoted[key]) for key in keys]
+
+    @staticmethod
+    def _normalize_fee_request(item):
+        shipping_fee_id, weight, country, *rest = item
+        postal_code = rest[0] if rest else ""
+        return (shipping_fee_id, weight, country, str(postal_code))
+
+    @staticmethod
+    def _make_shipping_fee_data(shipping_fee_id, weight, country="US", postal_code=""):
+        return {
             "data": "||".join([country, str(weight), str(postal_code)]),
             "ruleId": shipping_fee_id,
             "type": 1,
         }
-        r_data = self.request('post', api, data=data, params=params)
-        tree = html.fromstring(r_data["calculationRetHtml"])
+
+    @staticmethod
+    def _parse_shipping_fee(r_data, shipping_fee_id, weight, country):
         try:
-            return float(tree.xpath("//tr[1]/td[4]/span[1]/text()")[0])
-        except IndexError:
+            return float(parse_first_shipping_fee(r_data["calculationRetHtml"]))
+        except (KeyError, IndexError, ValueError):
             log = (
                 f"计算物流出错，请核对马帮物流自定义费用设置。"
                 f"物流费用规则ID: {shipping_fee_id}, 重量: {weight}, 国家: {country}"
@@ -0,0 +1,86 @@
+"""
+商品查询缓存
+
+用法:
+    api = MBApi(user, passwd, business_number, user_id, product_cache=ProductCache())
+"""
+import time
+import threading
+from collections import OrderedDict
+
+from .product import ProductSearchOperate
+
+
+class ProductCache():
+    """带过期时间的LRU缓存, 缓存ProductApi.get_product_info的查询结果
+    key为(search_type, search_key, search_content, operate), value为查询得到的商品列表.
+    查询不到结果(ProductNoExistError)时缓存空列表, 过期时间为negative_ttl.
+    :param maxsize: 最大缓存条数
+    :param ttl: 缓存有效期(秒)
+    :param negative_ttl: 查询不到结果的缓存有效期(秒)
+    """
+    def __init__(self, maxsize=10000, ttl=600, negative_ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """获取缓存的商品列表, 不存在或已过期时返回None"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return list(item[1])
+
+    def set(self, key, product_list):
+        ttl = self.ttl if product_list else self.negative_ttl
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, list(product_list))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, predicate=None):
+        """作废缓存
+        :param predicate: 接收key的函数, 返回True的缓存会被作废; 为None时清空缓存
+        """
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def invalidate_sku(self, sku, search_keys=None):
+        """作废所有查询结果可能包含sku的缓存
+        :param search_keys: 只作废这些search_key的缓存, 为None时不限
+        """
+        def predicate(key):
+            _, search_key, search_content, operate = key
+            if search_keys is not None and search_key not in search_keys:
+                return False
+            return match_sku(sku, search_content, operate)
+        self.invalidate(predicate)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data)}
+
+
+def match_sku(sku, search_content, operate):
+    """sku是否能被(search_content, operate)查询到"""
+    if operate == ProductSearchOperate.EQUAL:
+        return sku == search_content
+    if operate == ProductSearchOperate.LIKE_START:
+        return sku.startswith(search_content)
+    if operate == ProductSearchOperate.LIKE_END:
+        return sku.endswith(search_content)
+    return search_content in sku
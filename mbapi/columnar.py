@@ -0,0 +1,137 @@
+"""
+导出订单的列式输出
+
+把export_order等接口导出的订单行转为按列存储的Arrow表, 或直接写入Parquet/CSV文件,
+下游可直接读取或内存映射, 无需再解析xlsx.
+
+每个字段的列类型固定, 与批次内容无关, 不同批次导出的文件schema一致:
+EXPORT_INT_FIELDS中的字段为list<int64>, EXPORT_LIST_FIELDS中的字段为list<string>, 其余为string.
+被合并订单等字段会导出为多列, 超出headers的列合并到最后一个字段中, 列数始终与headers一致.
+
+Arrow/Parquet输出需要安装pyarrow: pip install mbapi[arrow]
+"""
+import csv
+
+from .constant import EXPORT_INT_FIELDS, EXPORT_LIST_FIELDS
+
+
+OUTPUT_MODES = ('list', 'arrow', 'parquet', 'csv')
+# 多值字段的分隔符
+VALUE_SEPARATOR = ';'
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError('arrow/parquet输出需要安装pyarrow: pip install mbapi[arrow]')
+    return pyarrow
+
+
+def _to_str(value):
+    if value == '' or value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        # 表格中的纯数字订单号会被读成浮点数
+        return str(int(value))
+    return str(value)
+
+
+def normalize_row(row, width):
+    """把订单行整理为width列的字符串, 空值为None
+    超出width的列合并到最后一列, 以VALUE_SEPARATOR分隔
+    """
+    values = [_to_str(value) for value in row]
+    values.extend([None] * (width - len(values)))
+    if len(values) > width:
+        rest = [value for value in values[width - 1:] if value is not None]
+        values = values[:width - 1] + [VALUE_SEPARATOR.join(rest) or None]
+    return values
+
+
+def _split_values(value):
+    if value is None:
+        return None
+    return [item for item in value.split(VALUE_SEPARATOR) if item]
+
+
+def _to_int_list(value):
+    items = _split_values(value)
+    if items is None:
+        return None
+    try:
+        return [int(float(item)) for item in items]
+    except ValueError:
+        raise ValueError(f'无法转为整数列表: {value}')
+
+
+def get_field_type(pa, name):
+    if name in EXPORT_INT_FIELDS:
+        return pa.list_(pa.int64()), _to_int_list
+    if name in EXPORT_LIST_FIELDS:
+        return pa.list_(pa.string()), _split_values
+    return pa.string(), None
+
+
+def get_schema(headers):
+    """headers对应的固定schema"""
+    pa = _import_pyarrow()
+    return pa.schema([(name, get_field_type(pa, name)[0]) for name in headers])
+
+
+def to_arrow_table(rows, headers):
+    """订单行转为pyarrow.Table
+    :param rows: 订单行的可迭代对象, 可以是iter_export_order的生成器
+    :param headers: 导出的字段列表
+    """
+    pa = _import_pyarrow()
+    width = len(headers)
+    columns = [[] for _ in headers]
+    for row in rows:
+        for column, value in zip(columns, normalize_row(row, width)):
+            column.append(value)
+    arrays = []
+    for name, values in zip(headers, columns):
+        field_type, convert = get_field_type(pa, name)
+        if convert is not None:
+            values = [convert(value) for value in values]
+        arrays.append(pa.array(values, type=field_type))
+    return pa.Table.from_arrays(arrays, schema=get_schema(headers))
+
+
+def write_parquet(rows, headers, path):
+    _import_pyarrow()
+    import pyarrow.parquet as pq
+    pq.write_table(to_arrow_table(rows, headers), path)
+    return path
+
+
+def write_csv(rows, headers, path):
+    """订单行逐行写入CSV, 不需要pyarrow
+    列数与headers一致, 多值字段以VALUE_SEPARATOR分隔
+    """
+    width = len(headers)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(headers)
+        for row in rows:
+            writer.writerow(normalize_row(row, width))
+    return path
+
+
+def convert_rows(rows, headers, output='list', path=None):
+    """按输出方式转换订单行
+    :param output: list: 列表; arrow: pyarrow.Table; parquet/csv: 写入path并返回path
+    :param path: parquet/csv输出的文件路径
+    """
+    if output not in OUTPUT_MODES:
+        raise ValueError(f'output只能为{OUTPUT_MODES}之一')
+    if output in ('parquet', 'csv') and not path:
+        raise ValueError(f'{output}输出需要指定path')
+    if output == 'list':
+        return list(rows)
+    if output == 'arrow':
+        return to_arrow_table(rows, headers)
+    if output == 'parquet':
+        return write_parquet(rows, headers, path)
+    return write_csv(rows, headers, path)
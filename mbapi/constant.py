@@ -315,3 +315,9 @@ EXPORT_FIELD_MAP = {
     '商品数量': 'uq121',
     '平台SKU': 'uq196',
 }
+
+# 导出字段的列类型, 其余字段(订单号, 货运单号等)均为字符串
+# 整数列表字段: 合并订单的值为"1;2", 单个订单为只有一个元素的列表
+EXPORT_INT_FIELDS = ('商品数量',)
+# 字符串列表字段: 以";"分隔或导出为多列的值
+EXPORT_LIST_FIELDS = ('被合并订单',)
@@ -0,0 +1,50 @@
+"""
+进程间文件锁, 非Windows使用fcntl, Windows使用msvcrt
+"""
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+
+@contextmanager
+def file_lock(path, shared=False):
+    """持有path对应的文件锁, 同一主机上的多个进程互斥
+    :param shared: 是否为共享锁(读锁), Windows下均为排他锁
+    """
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'a') as f:
+        _lock(f, shared)
+        try:
+            yield
+        finally:
+            _unlock(f)
+
+
+def _lock(f, shared):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return
+    f.seek(0)
+    while True:
+        # LK_LOCK重试10次后仍失败会抛出OSError, 继续等待
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            pass
+
+
+def _unlock(f):
+    if fcntl is not None:
+        fcntl.flock(f, fcntl.LOCK_UN)
+        return
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
@@ -0,0 +1,84 @@
+"""
+登录状态保活
+
+MBApiBase在请求时才检测登录状态, 登录状态过期后的第一个请求需要额外等待检测及重新登录.
+LoginKeepAlive在后台线程中, 于登录状态过期前重新检测各登录域, 必要时重新登录,
+使长时间运行的进程中请求耗时保持平稳.
+
+用法:
+    keepalive = LoginKeepAlive(api)
+    keepalive.start()
+    ...
+    keepalive.stop()
+"""
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from .base import LOGIN_EXPIRE, LOGIN_CHECK_DOMAINS
+
+
+logger = logging.getLogger(__name__)
+
+
+class LoginKeepAlive(threading.Thread):
+    """后台登录保活线程
+    :param api: MBApi实例
+    :param interval: 检查间隔(秒)
+    :param margin: 登录状态过期前多少秒开始刷新
+    :param callback: 每次刷新后调用, 参数为本次刷新结果字典, 见last_result
+    """
+    def __init__(self, api, interval=30, margin=60, callback=None):
+        super().__init__(name=f'mbapi-keepalive-{api.user}', daemon=True)
+        self.api = api
+        self.interval = interval
+        self.margin = timedelta(seconds=margin)
+        self.callback = callback
+        self.refresh_count = 0
+        self.failure_count = 0
+        # 最近一次刷新结果: {'domains': [...], 'duration': 秒, 'error': 异常或None}
+        self.last_result = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.refresh()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        if self.is_alive():
+            self.join(timeout)
+
+    def get_due_domains(self):
+        """即将过期的登录域"""
+        deadline = datetime.now() - LOGIN_EXPIRE + self.margin
+        return [
+            domain for domain in LOGIN_CHECK_DOMAINS
+            if self.api._login_datetimes.get(domain, datetime.min) <= deadline
+        ]
+
+    def refresh(self):
+        """刷新即将过期的登录域, 没有需要刷新的登录域时返回None"""
+        domains = self.get_due_domains()
+        if not domains:
+            return None
+        start = time.monotonic()
+        error = None
+        try:
+            with self.api._login_lock:
+                self.api._check_login(domains)
+        except Exception as e:
+            error = e
+            self.failure_count += 1
+            logger.exception('%s 刷新登录状态失败: %s', self.api.user, domains)
+        self.refresh_count += 1
+        self.last_result = {
+            'domains': domains,
+            'duration': time.monotonic() - start,
+            'error': error,
+        }
+        logger.info('%s 刷新登录状态 %s, 耗时%.2f秒', self.api.user, domains, self.last_result['duration'])
+        if self.callback is not None:
+            self.callback(self.last_result)
+        return self.last_result
@@ -0,0 +1,100 @@
+"""
+请求日志策略
+
+控制MBApi请求及返回内容的日志: 截断长度, 采样率, 日志级别以及敏感信息脱敏.
+日志内容在日志实际输出时才格式化, 对应级别未开启时没有格式化开销.
+
+用法:
+    api = MBApi(user, passwd, business_number, user_id, log_policy=LogPolicy(max_length=500, sample_rate=0.1))
+"""
+import re
+import random
+import logging
+
+
+DEFAULT_REDACT_KEYS = ('password', 'passwd', 'cookie', 'cmkey', 'mbkey')
+
+
+class _LazyText():
+    """日志输出时才执行格式化"""
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return self.func(*self.args)
+
+
+class LogPolicy():
+    """请求日志策略
+    :param max_length: 请求参数及返回内容的最大长度, 超出部分截断, None为不截断
+    :param sample_rate: 记录请求参数及返回内容的采样率, 0~1
+    :param level: 记录请求url的日志级别
+    :param body_level: 记录请求参数及返回内容的日志级别
+    :param redact_keys: 需要脱敏的参数名(不区分大小写, 包含即匹配)
+    """
+    def __init__(
+        self, max_length=1000, sample_rate=1.0, level=logging.INFO, body_level=logging.DEBUG,
+        redact_keys=DEFAULT_REDACT_KEYS,
+    ):
+        self.max_length = max_length
+        self.sample_rate = sample_rate
+        self.level = level
+        self.body_level = body_level
+        self.redact_keys = tuple(key.lower() for key in redact_keys)
+        self._redact_re = re.compile(
+            r'(?i)((?:%s)[^=&:\s"]*["\']?\s*[=:]\s*["\']?)[^&\s"\',;]+' % '|'.join(map(re.escape, self.redact_keys))
+        )
+
+    def _should_log_body(self, logger):
+        if not logger.isEnabledFor(self.body_level):
+            return False
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def log_request(self, logger, method, url, kw):
+        if logger.isEnabledFor(self.level):
+            logger.log(self.level, 'url=%s, method=%s', _LazyText(self.redact_text, url), method)
+        if self._should_log_body(logger):
+            logger.log(self.body_level, 'url=%s, kw=%s', _LazyText(self.redact_text, url), _LazyText(self.format_kw, kw))
+
+    def log_response(self, logger, name, r):
+        """记录返回内容
+        :param name: 日志中的接口名称
+        :param r: requests.Response, 返回的文本或解析后的json对象, 均在日志输出时才格式化
+        """
+        if self._should_log_body(logger):
+            logger.log(self.body_level, '%s返回: %s', name, _LazyText(self.format_response, r))
+
+    def format_kw(self, kw):
+        return self.truncate(str(self.redact(kw)))
+
+    def format_response(self, r):
+        if isinstance(r, (dict, list)):
+            return self.truncate(str(self.redact(r)))
+        text = r if isinstance(r, str) else getattr(r, 'text', r)
+        return self.truncate(self.redact_text(str(text)))
+
+    def truncate(self, text):
+        if self.max_length is None or len(text) <= self.max_length:
+            return text
+        return f'{text[:self.max_length]}...(共{len(text)}字符)'
+
+    def _is_redact_key(self, key):
+        key = str(key).lower()
+        return any(redact_key in key for redact_key in self.redact_keys)
+
+    def redact(self, value):
+        """对dict, (key, value)列表中的敏感参数脱敏"""
+        if isinstance(value, dict):
+            return {k: '***' if self._is_redact_key(k) else self.redact(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [
+                (item[0], '***') if isinstance(item, tuple) and len(item) == 2 and self._is_redact_key(item[0])
+                else self.redact(item)
+                for item in value
+            ]
+        return value
+
+    def redact_text(self, text):
+        """对url及文本中形如key=value的敏感参数脱敏"""
+        return self._redact_re.sub(r'\1***', str(text))
@@ -0,0 +1,138 @@
+"""
+接口调用指标
+
+MBApi.request按接口(mod或m.a)统计调用次数, 耗时分布, 请求及返回字节数,
+HTTP状态码, 业务错误, urllib3重试及重新登录次数.
+
+用法:
+    api.metrics.snapshot()
+    api.metrics.to_prometheus()
+"""
+import threading
+from urllib.parse import urlparse, parse_qs
+
+
+# 耗时分布的桶(秒)
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+COUNTER_NAMES = (
+    'calls',
+    'request_errors',
+    'biz_errors',
+    'retries',
+    'relogins',
+    'request_bytes',
+    'response_bytes',
+)
+
+
+class EndpointMetrics():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counters = dict.fromkeys(COUNTER_NAMES, 0)
+        self.status = {}
+        self.latency_buckets = [0] * len(buckets)
+        self.latency_sum = 0.0
+        self.latency_count = 0
+
+    def observe_latency(self, duration):
+        self.latency_sum += duration
+        self.latency_count += 1
+        for i, bound in enumerate(self.buckets):
+            if duration <= bound:
+                self.latency_buckets[i] += 1
+
+    def snapshot(self):
+        return {
+            **self.counters,
+            'status': dict(self.status),
+            'latency': {
+                'sum': self.latency_sum,
+                'count': self.latency_count,
+                'buckets': dict(zip(self.buckets, self.latency_buckets)),
+            },
+        }
+
+
+class MetricsRegistry():
+    """按接口统计的调用指标, 线程安全
+    :param buckets: 耗时分布的桶(秒)
+    """
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_endpoint(url, params=None):
+        """根据url及params得到接口名: mod参数, 或镖局接口的m.a参数, 都没有时为url路径"""
+        query = {k: v[0] for k, v in parse_qs(urlparse(url).query).items()}
+        if isinstance(params, dict):
+            query.update(params)
+        if query.get('mod'):
+            return str(query['mod'])
+        if query.get('m') and query.get('a'):
+            return f"{query['m']}.{query['a']}"
+        parsed = urlparse(url)
+        return f'{parsed.netloc}{parsed.path}'
+
+    def _get(self, endpoint):
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = EndpointMetrics(self.buckets)
+        return metrics
+
+    def observe(self, endpoint, duration, status=None, request_bytes=0, response_bytes=0, retries=0):
+        """记录一次调用"""
+        with self._lock:
+            metrics = self._get(endpoint)
+            metrics.counters['calls'] += 1
+            metrics.counters['request_bytes'] += request_bytes
+            metrics.counters['response_bytes'] += response_bytes
+            metrics.counters['retries'] += retries
+            if status is None:
+                metrics.counters['request_errors'] += 1
+            else:
+                metrics.status[status] = metrics.status.get(status, 0) + 1
+            metrics.observe_latency(duration)
+
+    def inc(self, endpoint, name, value=1):
+        """增加计数, name见COUNTER_NAMES"""
+        with self._lock:
+            self._get(endpoint).counters[name] += value
+
+    def reset(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def snapshot(self):
+        """{接口名: 指标字典}"""
+        with self._lock:
+            return {endpoint: metrics.snapshot() for endpoint, metrics in self._endpoints.items()}
+
+    def to_prometheus(self, prefix='mbapi'):
+        """Prometheus文本格式"""
+        snapshot = self.snapshot()
+        lines = []
+        for name in COUNTER_NAMES:
+            metric = f'{prefix}_{name}_total'
+            lines.append(f'# TYPE {metric} counter')
+            for endpoint, item in snapshot.items():
+                lines.append(f'{metric}{{endpoint="{endpoint}"}} {item[name]}')
+
+        metric = f'{prefix}_http_status_total'
+        lines.append(f'# TYPE {metric} counter')
+        for endpoint, item in snapshot.items():
+            for status, count in item['status'].items():
+                lines.append(f'{metric}{{endpoint="{endpoint}",status="{status}"}} {count}')
+
+        metric = f'{prefix}_request_duration_seconds'
+        lines.append(f'# TYPE {metric} histogram')
+        for endpoint, item in snapshot.items():
+            latency = item['latency']
+            for bound, count in latency['buckets'].items():
+                lines.append(f'{metric}_bucket{{endpoint="{endpoint}",le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{endpoint="{endpoint}",le="+Inf"}} {latency["count"]}')
+            lines.append(f'{metric}_sum{{endpoint="{endpoint}"}} {latency["sum"]}')
+            lines.append(f'{metric}_count{{endpoint="{endpoint}"}} {latency["count"]}')
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,105 @@
+"""
+流式multipart/form-data编码
+
+requests的files参数会把整个文件读入内存再编码, MultipartEncoder则在发送时
+按块从文件中读取, 上传大文件时内存占用与文件大小无关.
+
+用法:
+    body = MultipartEncoder([('templateId', 1)], [('templetfile', 'order.xlsx', fp, XLSX_CONTENT_TYPE)])
+    session.post(url, data=body, headers={'Content-Type': body.content_type})
+"""
+import os
+import uuid
+
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+class MultipartEncoder():
+    """可作为requests请求体的multipart编码器
+    :param fields: (name, value)列表
+    :param files: (name, filename, fileobj, content_type)列表, fileobj需支持seek/tell
+    """
+    chunk_size = 64 * 1024
+
+    def __init__(self, fields=(), files=()):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={self.boundary}'
+        # 每个元素为bytes或(fileobj, 起始位置, 长度)
+        self._parts = []
+        for name, value in fields:
+            self._parts.append(
+                self._header(name) + b'\r\n' + str(value).encode('utf-8') + b'\r\n'
+            )
+        for name, filename, fileobj, content_type in files:
+            start = fileobj.tell()
+            fileobj.seek(0, os.SEEK_END)
+            length = fileobj.tell() - start
+            fileobj.seek(start)
+            self._parts.append(
+                self._header(name, filename) + f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8')
+            )
+            self._parts.append((fileobj, start, length))
+            self._parts.append(b'\r\n')
+        self._parts.append(f'--{self.boundary}--\r\n'.encode('utf-8'))
+        self.len = sum(self._part_len(part) for part in self._parts)
+        self._index = 0
+        self._offset = 0
+        self._position = 0
+
+    def _header(self, name, filename=None):
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        return f'--{self.boundary}\r\nContent-Disposition: {disposition}\r\n'.encode('utf-8')
+
+    @staticmethod
+    def _part_len(part):
+        return len(part) if isinstance(part, bytes) else part[2]
+
+    def __len__(self):
+        return self.len
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """只支持回到开头, 用于请求重试"""
+        if offset != 0 or whence != os.SEEK_SET:
+            raise OSError('MultipartEncoder只支持seek(0)')
+        self._index = 0
+        self._offset = 0
+        self._position = 0
+        return 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len - self._position
+        chunks = []
+        while size > 0 and self._index < len(self._parts):
+            part = self._parts[self._index]
+            remain = self._part_len(part) - self._offset
+            n = min(size, remain)
+            if isinstance(part, bytes):
+                chunk = part[self._offset:self._offset + n]
+            else:
+                fileobj, start, _ = part
+                fileobj.seek(start + self._offset)
+                chunk = fileobj.read(n)
+                if len(chunk) != n:
+                    raise OSError('上传过程中文件被修改')
+            chunks.append(chunk)
+            size -= n
+            self._offset += n
+            self._position += n
+            if self._offset == self._part_len(part):
+                self._index += 1
+                self._offset = 0
+        return b''.join(chunks)
@@ -0,0 +1,104 @@
+"""
+马帮返回的html片段解析
+
+各接口返回的html片段只解析一次, 使用预编译的XPath提取字段, 避免每行重新编译表达式.
+XPath均设置smart_strings=False, 返回普通str, 不持有对文档树的引用.
+
+性能测试见benchmarks/bench_parsing.py
+"""
+from lxml import etree, html
+
+
+def _xpath(path):
+    return etree.XPath(path, smart_strings=False)
+
+
+ROWS = _xpath('//tr')
+TD1_TEXT = _xpath('./td[1]/text()')
+TD2_TEXT = _xpath('./td[2]//text()')
+TD2_LINK_TEXT = _xpath('./td[2]/a/text()')
+TD3_TEXT = _xpath('./td[3]/text()')
+TD4_TEXT = _xpath('./td[4]/text()')
+
+# 组合SKU列表
+COMBO_SKU_ROWS = _xpath('//tr/td[3]/p/a/../../..')
+COMBO_SKU = _xpath('./td[3]/p/a/text()')
+COMBO_SKU_COST = _xpath('./td[6]/text()')
+COMBO_SKU_WEIGHT = _xpath('./td[8]/text()')
+
+# 订单的物流信息
+LOGISTICS_SHIP_SERV = _xpath('./p[1]/text()')
+
+# 相关订单
+RELATED_ORDER_ID = _xpath('./td[1]/a/text()')
+RELATED_ORDER_STATUS = _xpath('./td[2]/text()')
+RELATED_ORDER_SEND_TIME = _xpath('./td[4]/p[1]/text()')
+
+# 镖局运费测算结果
+SHIPPING_FEE_PRICE = _xpath('./td[4]/span[1]/text()')
+SHIPPING_FEE_CELLS = _xpath('./td')
+CELL_TEXT = _xpath('.//text()')
+FIRST_SHIPPING_FEE_PRICE = _xpath('//tr[1]/td[4]/span[1]/text()')
+
+
+def parse_fragment(text):
+    """解析html片段, 与html.fromstring一致"""
+    return html.fromstring(text)
+
+
+def parse_op_log_rows(html_text):
+    """订单操作日志
+    :return: [(操作属性, 描述, 操作员, 操作时间, 描述中的链接文本列表)]
+    """
+    return [
+        (
+            TD1_TEXT(tr)[0],
+            ''.join(TD2_TEXT(tr)),
+            TD3_TEXT(tr)[0],
+            TD4_TEXT(tr)[0],
+            TD2_LINK_TEXT(tr),
+        )
+        for tr in ROWS(parse_fragment(html_text))
+    ]
+
+
+def parse_combo_sku_rows(message):
+    """组合SKU列表中每个商品对应的tr元素"""
+    return COMBO_SKU_ROWS(parse_fragment(message))
+
+
+def parse_combo_sku_row(tr):
+    """:return: (sku, 成本, 重量)"""
+    return COMBO_SKU(tr)[0], float(COMBO_SKU_COST(tr)[0]), float(COMBO_SKU_WEIGHT(tr)[0])
+
+
+def parse_logistics_ship_serv(logistics_html):
+    """订单的物流渠道名称"""
+    return LOGISTICS_SHIP_SERV(parse_fragment(logistics_html))[0].strip()
+
+
+def parse_related_order_rows(order_html):
+    """相关订单
+    :return: [(订单编号, 状态, 发货时间)]
+    """
+    return [
+        (RELATED_ORDER_ID(tr)[0], RELATED_ORDER_STATUS(tr)[0], RELATED_ORDER_SEND_TIME(tr)[0])
+        for tr in ROWS(parse_fragment(order_html))
+    ]
+
+
+def parse_shipping_fee_detail_rows(fee_html):
+    """运费测算结果中每一行的单元格文本及价格文本
+    :return: [(单元格文本列表, 价格文本或None)]
+    """
+    ret = []
+    for tr in ROWS(parse_fragment(fee_html)):
+        cells = [''.join(CELL_TEXT(td)).strip() for td in SHIPPING_FEE_CELLS(tr)]
+        price = SHIPPING_FEE_PRICE(tr)
+        ret.append((cells, price[0] if price else None))
+    return ret
+
+
+def parse_first_shipping_fee(fee_html):
+    """运费测算结果第一行的价格文本, 没有时抛出IndexError"""
+    return FIRST_SHIPPING_FEE_PRICE(parse_fragment(fee_html))[0]
@@ -0,0 +1,127 @@
+"""
+多会话连接池
+
+马帮按会话限流, 单个MBApi的吞吐有上限. MBApiPool持有多个已登录的MBApi实例,
+每次调用分配给未完成请求数最少的实例, 出错的实例暂时移出轮转.
+
+用法:
+    pool = MBApiPool.from_accounts([
+        (user1, passwd1, business_number, user_id1),
+        (user2, passwd2, business_number, user_id2),
+    ])
+    order = pool.get_order(order_id)
+"""
+import time
+import inspect
+import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from . import MBApi
+from .exceptions import LoginError, MBApiRequestError
+
+
+logger = logging.getLogger(__name__)
+
+
+class _PoolMember():
+    def __init__(self, api):
+        self.api = api
+        self.outstanding = 0
+        self.unhealthy_until = 0
+
+
+class MBApiPool():
+    """MBApi实例池, 方法与MBApi一致
+    :param apis: MBApi实例列表, 可以是同一账号或不同账号
+    :param unhealthy_seconds: 实例出现LoginError/MBApiRequestError后移出轮转的时间(秒)
+    """
+    def __init__(self, apis, unhealthy_seconds=60):
+        if not apis:
+            raise ValueError('apis不能为空')
+        self.unhealthy_seconds = unhealthy_seconds
+        self._members = [_PoolMember(api) for api in apis]
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_accounts(cls, accounts, unhealthy_seconds=60, **kw):
+        """根据账号列表创建实例池
+        :param accounts: (user, passwd, business_number, user_id)列表
+        :param kw: 传给MBApi的其他参数
+        """
+        return cls([MBApi(*account, **kw) for account in accounts], unhealthy_seconds)
+
+    def __len__(self):
+        return len(self._members)
+
+    @contextmanager
+    def acquire(self):
+        """获取一个MBApi实例, 优先选择健康且未完成请求数最少的实例"""
+        with self._lock:
+            now = time.monotonic()
+            healthy = [member for member in self._members if member.unhealthy_until <= now]
+            if healthy:
+                member = min(healthy, key=lambda member: member.outstanding)
+            else:
+                # 全部不健康时使用最早恢复的实例
+                member = min(self._members, key=lambda member: member.unhealthy_until)
+            member.outstanding += 1
+        try:
+            yield member.api
+        except (LoginError, MBApiRequestError) as e:
+            logger.warning('%s 请求出错, 暂停使用%s秒: %s', member.api.user, self.unhealthy_seconds, e)
+            with self._lock:
+                member.unhealthy_until = time.monotonic() + self.unhealthy_seconds
+            raise
+        finally:
+            with self._lock:
+                member.outstanding -= 1
+
+    def stats(self):
+        """各实例的状态"""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    'user': member.api.user,
+                    'outstanding': member.outstanding,
+                    'healthy': member.unhealthy_until <= now,
+                }
+                for member in self._members
+            ]
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(MBApi, name, None)):
+            raise AttributeError(name)
+
+        if inspect.isgeneratorfunction(inspect.unwrap(getattr(MBApi, name))):
+            # 生成器方法在迭代过程中持有实例, 迭代出错时同样将实例移出轮转
+            def method(*args, **kw):
+                with self.acquire() as api:
+                    yield from getattr(api, name)(*args, **kw)
+        else:
+            def method(*args, **kw):
+                with self.acquire() as api:
+                    return getattr(api, name)(*args, **kw)
+        method.__name__ = name
+        method.__doc__ = getattr(MBApi, name).__doc__
+        return method
+
+    def get_order_shipping_info_by_ids(self, order_ids: list, chunk_size=100):
+        '''获取物流信息, 订单分块后由池中各实例并发查询
+        :return: 与MBApi.get_order_shipping_info_by_ids一致
+        '''
+        chunks = [order_ids[i:i + chunk_size] for i in range(0, len(order_ids), chunk_size)]
+
+        def query(chunk):
+            with self.acquire() as api:
+                return api.get_order_shipping_info_by_ids(chunk)
+
+        shipping_info_list = []
+        no_exist_ids = []
+        with ThreadPoolExecutor(max_workers=len(self._members)) as executor:
+            for chunk_info_list, chunk_no_exist_ids in executor.map(query, chunks):
+                shipping_info_list.extend(chunk_info_list)
+                no_exist_ids.extend(chunk_no_exist_ids)
+        return shipping_info_list, no_exist_ids
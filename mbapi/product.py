@@ -1,17 +1,24 @@
 import re
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 
-from lxml import html
-
 from .base import MBApiBase
 from .constant import (
     MB_API,
     AAMZ_API,
 )
 from .exceptions import (
+    MBApiError,
     ProductNoExistError,
     ProductMultiError,
 )
+from .tracing import traced, bind_span
+from .parsing import parse_combo_sku_rows, parse_combo_sku_row
+
+
+# 分页查询商品时每页的数量
+PRODUCT_SEARCH_PAGE_SIZE = 100
 
 
 class SpecialAttr:
@@ -158,10 +165,10 @@ class Product():
 
     @classmethod
     def from_html_tree(cls, html_tree):
-        sku = html_tree.xpath("./td[3]/p/a/text()")[0]
+        sku, cost, weight = parse_combo_sku_row(html_tree)
         product = Product(sku)
-        product.cost = float(html_tree.xpath("./td[6]/text()")[0])
-        product.weight = float(html_tree.xpath("./td[8]/text()")[0])
+        product.cost = cost
+        product.weight = weight
         # TODO: 组合SKU默认为特货
         product.is_battery = True
         return product
@@ -170,39 +177,66 @@ class Product():
 class ProductApi(MBApiBase):
     def get_stock_sku_info_list(
         self, search_key: StockProductSearchKey,
-        search_content: str, operate: ProductSearchOperate
+        search_content: str, operate: ProductSearchOperate,
+        page=None, rows_per_page=PRODUCT_SEARCH_PAGE_SIZE,
     ) -> list:
         '''获取库存SKU商品数据
         :param search_key: 查询方式
         :param content: 查询内容，目前用于sku搜索
+        :param page: 页码, 从1开始, 为None时不传分页参数
         :return: 返回产品列表
         '''
         api = AAMZ_API
         params = {
             "mod": "stock.getStockList"
         }
+        data = self._make_stock_list_data(search_key, search_content, operate)
+        if page is not None:
+            data.update({'page': page, 'rowsPerPage': rows_per_page})
+        r_data = self.request('post', api, data=data, params=params)
+        stock_data_list = r_data.get('stockData', [])
+        return [Product.from_api(stock_data) for stock_data in stock_data_list]
+
+    def get_stock_list_page(self, page: int, rows_per_page: int = 100) -> list:
+        '''分页获取库存商品的原始数据
+        :param page: 页码, 从1开始
+        :return: stockData列表
+        '''
+        api = AAMZ_API
+        params = {
+            "mod": "stock.getStockList"
+        }
+        data = {
+            'page': page,
+            'rowsPerPage': rows_per_page,
+            'status': 3,
+        }
+        r_data = self.request('post', api, data=data, params=params)
+        return r_data.get('stockData', [])
+
+    @staticmethod
+    def _make_stock_list_data(search_key, search_content, operate):
         search_key_map = {
             'Stock_stockSku': '库存sku编号',
             'StockVirtualSku_virtualSku': '虚拟sku编号'
         }
-        data = {
+        return {
             'searchKey': search_key,
             'search-content': search_key_map[search_key],
             'searchValue': search_content,
             'operate': operate,
             'status': 3,
         }
-        r_data = self.request('post', api, data=data, params=params)
-        stock_data_list = r_data.get('stockData', [])
-        return [Product.from_api(stock_data) for stock_data in stock_data_list]
 
     def get_combo_sku_info_list(
         self, search_key: StockProductSearchKey,
-        search_content: str, operate: ProductSearchOperate
+        search_content: str, operate: ProductSearchOperate,
+        page=None, rows_per_page=PRODUCT_SEARCH_PAGE_SIZE,
     ) -> list:
         '''获取库存SKU商品数据
         :param search_key: 查询方式
         :param content: 查询内容，目前用于sku搜索
+        :param page: 页码, 从1开始, 为None时不传分页参数
         :return: 返回产品列表
         '''
         api = AAMZ_API
@@ -214,31 +248,86 @@ class ProductApi(MBApiBase):
             'searchKeywords': search_content,
             'operate': operate,
         }
+        if page is not None:
+            data.update({'page': page, 'rowsPerPage': rows_per_page})
         r_data = self.request('post', api, data=data, params=params)
-        tree = html.fromstring(r_data["message"])
-        ret_list = []
-        for p_tree in tree.xpath("//tr/td[3]/p/a/../../.."):
-            ret_list.append(Product.from_html_tree(p_tree))
-        return ret_list
+        return self._parse_combo_sku_html(r_data["message"])
+
+    @staticmethod
+    def _parse_combo_sku_html(message):
+        return [Product.from_html_tree(p_tree) for p_tree in parse_combo_sku_rows(message)]
 
     def get_product_info(
         self, search_key,
         search_content: str, operate: ProductSearchOperate,
         error=True,
         search_type: ProductSearchType = ProductSearchType.STOCK_SKU_TYPE,
+        live=False,
     ) -> list:
         """查询产品信息
         :param search_key: StockProductSearchKey 或 ComboProductSearchKey, 根据search_type进行输入
+        :param live: 是否跳过product_cache及product_index直接请求马帮接口
+        """
+        product_list = self._search_product_list(search_key, search_content, operate, search_type, live=live)
+        return self._select_product(product_list, search_key, search_content, error)
+
+    def _search_product_list(self, search_key, search_content, operate, search_type, all_pages=False, live=False):
+        """查询产品列表
+        设置了product_cache时优先从缓存获取, 其次从product_index获取, 都获取不到时才请求马帮接口
+        :param all_pages: 是否读取所有分页, 不读取时只返回马帮默认的第一页
+        :param live: 是否跳过缓存及索引直接请求马帮接口, 请求结果仍会写入缓存
         """
+        # 单页的结果可能不完整, 与所有分页的结果分开缓存
+        cache_key = (f'{search_type}:all_pages' if all_pages else search_type, search_key, search_content, operate)
+        if self.product_cache is not None and not live:
+            product_list = self.product_cache.get(cache_key)
+            if product_list is not None:
+                return product_list
+
+        if self.product_index is not None and search_type == ProductSearchType.STOCK_SKU_TYPE and not live:
+            product_list = self.product_index.lookup(search_key, search_content, operate)
+            if product_list:
+                if self.product_cache is not None:
+                    self.product_cache.set(cache_key, product_list)
+                return product_list
+
         if search_type == ProductSearchType.STOCK_SKU_TYPE:
-            operate = self._get_search_operater(search_type, operate)
-            product_list = self.get_stock_sku_info_list(search_key, search_content, operate)
+            search = self.get_stock_sku_info_list
         elif search_type == ProductSearchType.COMBO_SKU_TYPE:
-            operate = self._get_search_operater(search_type, operate)
-            product_list = self.get_combo_sku_info_list(search_key, search_content, operate)
+            search = self.get_combo_sku_info_list
         else:
             raise ValueError(f"search_type: {search_type} 错误")
+        operate = self._get_search_operater(search_type, operate)
+        if all_pages:
+            product_list = self._search_all_pages(
+                lambda page: search(search_key, search_content, operate, page=page)
+            )
+        else:
+            product_list = search(search_key, search_content, operate)
+
+        if self.product_cache is not None:
+            self.product_cache.set(cache_key, product_list)
+        return product_list
 
+    @staticmethod
+    def _search_all_pages(search_page):
+        """逐页查询直到某一页没有新的商品
+        不以返回行数少于每页数量作为最后一页, 马帮可能忽略rowsPerPage而使用更小的默认分页
+        :param search_page: 接收页码返回商品列表的函数
+        """
+        product_map = {}
+        for page in count(1):
+            new_product_map = {
+                product.sku: product for product in search_page(page) if product.sku not in product_map
+            }
+            if not new_product_map:
+                break
+            product_map.update(new_product_map)
+        return list(product_map.values())
+
+    @classmethod
+    def _select_product(cls, product_list, search_key, search_content, error=True):
+        """从查询结果中选出唯一的商品"""
         if len(product_list) == 0:
             if error:
                 raise ProductNoExistError('key:[%s] content:[%s] 查寻不到结果!' % (search_key, search_content))
@@ -246,7 +335,7 @@ class ProductApi(MBApiBase):
                 return Product(None)
 
         elif len(product_list) > 1:
-            main_sku = self.get_main_sku(product_list[0].sku)
+            main_sku = cls.get_main_sku(product_list[0].sku)
             # 如果匹配出来的结果不是属于同种商品
             if not all((product.sku.startswith(main_sku) for product in product_list[1:])):
                 if error:
@@ -255,6 +344,53 @@ class ProductApi(MBApiBase):
                     return Product(None)
         return product_list[0]
 
+    @traced
+    def get_products_bulk(self, skus, max_workers=10):
+        """批量查询库存SKU/组合SKU商品信息
+        按主sku分组, 每个主sku查询一次(like_start, 读取所有分页), 再从结果中找出完全匹配的sku
+        :param skus: sku列表, ZH开头的为组合SKU
+        :param max_workers: 最大并发请求数
+        :return: ({sku: Product}, 查询不到的sku列表, {查询出错的sku: 异常})
+        """
+        group_map = {}
+        for sku in dict.fromkeys(skus):
+            try:
+                main_sku = self.get_main_sku(sku)
+            except AttributeError:
+                # 不符合主sku格式的按自身查询
+                main_sku = sku
+            group_map.setdefault(main_sku, []).append(sku)
+
+        def search(main_sku):
+            if main_sku.startswith("ZH"):
+                search_type = ProductSearchType.COMBO_SKU_TYPE
+                search_key = ComboProductSearchKey.COMBO_SKU
+            else:
+                search_type = ProductSearchType.STOCK_SKU_TYPE
+                search_key = StockProductSearchKey.STOCK_SKU
+            try:
+                return self._search_product_list(
+                    search_key, main_sku, ProductSearchOperate.LIKE_START, search_type, all_pages=True
+                ), None
+            except MBApiError as e:
+                return None, e
+
+        product_map = {}
+        misses = []
+        errors = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for main_sku, (product_list, error) in zip(group_map, executor.map(bind_span(search), group_map)):
+                if error is not None:
+                    errors.update(dict.fromkeys(group_map[main_sku], error))
+                    continue
+                sku_product_map = {product.sku: product for product in product_list}
+                for sku in group_map[main_sku]:
+                    if sku in sku_product_map:
+                        product_map[sku] = sku_product_map[sku]
+                    else:
+                        misses.append(sku)
+        return product_map, misses, errors
+
     @staticmethod
     def get_main_sku(sku):
         '''获取主sku, 即子sku前缀. 如: TT0183F -> TT0183'''
@@ -269,12 +405,13 @@ class ProductApi(MBApiBase):
             search_key = StockProductSearchKey.STOCK_SKU
         return self.get_product_info(search_key, sku, operate, error=error, search_type=search_type)
 
-    def get_product_info_from_virtual_sku(self, sku, operate=ProductSearchOperate.LIKE_START, error=True):
+    def get_product_info_from_virtual_sku(self, sku, operate=ProductSearchOperate.LIKE_START, error=True, live=False):
         search_type = ProductSearchType.STOCK_SKU_TYPE
         search_key = StockProductSearchKey.VIRTUAL_SKU
-        return self.get_product_info(search_key, sku, operate, error=error, search_type=search_type)
+        return self.get_product_info(search_key, sku, operate, error=error, search_type=search_type, live=live)
 
-    def _get_search_operater(self, search_type: ProductSearchType, operate: ProductSearchOperate):
+    @staticmethod
+    def _get_search_operater(search_type: ProductSearchType, operate: ProductSearchOperate):
         stock_type_map = {
             ProductSearchOperate.EQUAL: StockProductSearchOperate.EQUAL,
             ProductSearchOperate.LIKE: StockProductSearchOperate.LIKE,
@@ -0,0 +1,195 @@
+"""
+本地商品索引
+
+把stock.getStockList中的全部库存商品同步到本地sqlite文件,
+按库存sku, 虚拟sku, 主sku建立索引. ProductApi设置了product_index后,
+库存sku的查询优先从索引中获取, 索引中查询不到时再请求马帮接口.
+
+用法:
+    index = ProductIndex('products.db', api)
+    index.sync()
+    api = MBApi(user, passwd, business_number, user_id, product_index=index)
+"""
+import json
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .product import (
+    Product,
+    ProductApi,
+    ProductSearchOperate,
+    StockProductSearchKey,
+)
+
+
+logger = logging.getLogger(__name__)
+
+# stockData中虚拟sku的字段名
+VIRTUAL_SKU_FIELD = 'virtualSku'
+# 同步时最多读取的页数
+MAX_SYNC_PAGES = 10000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    stock_sku TEXT PRIMARY KEY,
+    main_sku TEXT,
+    page INTEGER,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS products_main_sku ON products (main_sku);
+CREATE INDEX IF NOT EXISTS products_page ON products (page);
+CREATE TABLE IF NOT EXISTS virtual_skus (
+    virtual_sku TEXT,
+    stock_sku TEXT
+);
+CREATE INDEX IF NOT EXISTS virtual_skus_virtual_sku ON virtual_skus (virtual_sku);
+CREATE INDEX IF NOT EXISTS virtual_skus_stock_sku ON virtual_skus (stock_sku);
+CREATE TABLE IF NOT EXISTS pages (
+    page INTEGER PRIMARY KEY,
+    digest TEXT,
+    synced_at REAL
+);
+"""
+
+
+class ProductIndex():
+    """库存商品的本地sqlite索引
+    :param path: sqlite文件路径
+    :param api: ProductApi实例, 用于同步数据
+    """
+    def __init__(self, path, api=None):
+        self.path = path
+        self.api = api
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def close(self):
+        self._conn.close()
+
+    def sync(self, rows_per_page=100, max_workers=5, max_pages=MAX_SYNC_PAGES):
+        """增量同步商品数据
+        逐页拉取库存列表, 只有内容发生变化的页才会重写到索引中.
+        马帮可能忽略rowsPerPage或page参数, 因此不以返回数量少于每页数量判断最后一页,
+        而是读到没有新stockSku的页为止; 只有正常读到最后一页时才删除多余的页.
+        :param max_pages: 最多读取的页数, 超出时停止同步且不删除索引中的数据
+        :return: {'pages': 总页数, 'changed': 变化的页数, 'complete': 是否读到了最后一页}
+        """
+        page = 1
+        changed = 0
+        last_page = 0
+        complete = False
+        seen_skus = set()
+
+        def fetch(n):
+            return self.api.get_stock_list_page(n, rows_per_page)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while not complete and page <= max_pages:
+                pages = list(range(page, min(page + max_workers, max_pages + 1)))
+                for n, stock_data_list in zip(pages, executor.map(fetch, pages)):
+                    skus = set(stock_data['stockSku'] for stock_data in stock_data_list)
+                    if not skus - seen_skus:
+                        complete = True
+                        break
+                    seen_skus.update(skus)
+                    last_page = n
+                    changed += self._update_page(n, stock_data_list)
+                page += len(pages)
+        if not complete:
+            logger.warning('商品索引同步超过%s页仍未结束, 不删除索引中多余的数据', max_pages)
+            return {'pages': last_page, 'changed': changed, 'complete': False}
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM products WHERE page > ?', (last_page,))
+            self._conn.execute(
+                'DELETE FROM virtual_skus WHERE stock_sku NOT IN (SELECT stock_sku FROM products)'
+            )
+            self._conn.execute('DELETE FROM pages WHERE page > ?', (last_page,))
+        logger.info('商品索引同步完成, 共%s页, 变化%s页', last_page, changed)
+        return {'pages': last_page, 'changed': changed, 'complete': True}
+
+    def _update_page(self, page, stock_data_list):
+        """更新一页数据, 返回该页是否有变化"""
+        raw = json.dumps(stock_data_list, sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha1(raw.encode('utf-8')).hexdigest()
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT digest FROM pages WHERE page = ?', (page,)).fetchone()
+            if row and row[0] == digest:
+                return False
+            old_skus = [r[0] for r in self._conn.execute(
+                'SELECT stock_sku FROM products WHERE page = ?', (page,)
+            )]
+            self._conn.executemany('DELETE FROM virtual_skus WHERE stock_sku = ?', [(sku,) for sku in old_skus])
+            self._conn.execute('DELETE FROM products WHERE page = ?', (page,))
+            for stock_data in stock_data_list:
+                stock_sku = stock_data['stockSku']
+                try:
+                    main_sku = ProductApi.get_main_sku(stock_sku)
+                except AttributeError:
+                    main_sku = stock_sku
+                self._conn.execute('DELETE FROM virtual_skus WHERE stock_sku = ?', (stock_sku,))
+                self._conn.execute(
+                    'INSERT OR REPLACE INTO products (stock_sku, main_sku, page, data) VALUES (?, ?, ?, ?)',
+                    (stock_sku, main_sku, page, json.dumps(stock_data, ensure_ascii=False)),
+                )
+                self._conn.executemany(
+                    'INSERT INTO virtual_skus (virtual_sku, stock_sku) VALUES (?, ?)',
+                    [(vir_sku, stock_sku) for vir_sku in self._get_virtual_skus(stock_data)],
+                )
+            self._conn.execute(
+                'INSERT OR REPLACE INTO pages (page, digest, synced_at) VALUES (?, ?, ?)',
+                (page, digest, time.time()),
+            )
+        return True
+
+    @staticmethod
+    def _get_virtual_skus(stock_data):
+        vir_skus = stock_data.get(VIRTUAL_SKU_FIELD) or []
+        if isinstance(vir_skus, str):
+            vir_skus = vir_skus.replace(',', ' ').split()
+        return [sku for sku in vir_skus if sku]
+
+    def lookup(self, search_key, search_content, operate=ProductSearchOperate.LIKE_START) -> list:
+        """按ProductSearchOperate的匹配规则查询商品
+        :param search_key: StockProductSearchKey
+        :return: 商品列表, 查询不到时为空列表
+        """
+        if search_key == StockProductSearchKey.STOCK_SKU:
+            column = 'products.stock_sku'
+            sql = 'SELECT data FROM products WHERE {} ORDER BY stock_sku'
+        elif search_key == StockProductSearchKey.VIRTUAL_SKU:
+            column = 'virtual_skus.virtual_sku'
+            sql = (
+                'SELECT DISTINCT data FROM products JOIN virtual_skus USING (stock_sku) '
+                'WHERE {} ORDER BY products.stock_sku'
+            )
+        else:
+            raise ValueError(f"search_key: {search_key} 错误")
+        condition, value = self._make_condition(column, search_content, operate)
+        with self._lock:
+            rows = self._conn.execute(sql.format(condition), (value,)).fetchall()
+        return [Product.from_api(json.loads(row[0])) for row in rows]
+
+    def lookup_main_sku(self, main_sku) -> list:
+        """查询主sku下的所有商品"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT data FROM products WHERE main_sku = ? ORDER BY stock_sku', (main_sku,)
+            ).fetchall()
+        return [Product.from_api(json.loads(row[0])) for row in rows]
+
+    @staticmethod
+    def _make_condition(column, search_content, operate):
+        if operate == ProductSearchOperate.EQUAL:
+            return f'{column} = ?', search_content
+        escaped = search_content.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        pattern_map = {
+            ProductSearchOperate.LIKE_START: f'{escaped}%',
+            ProductSearchOperate.LIKE_END: f'%{escaped}',
+            ProductSearchOperate.LIKE: f'%{escaped}%',
+        }
+        return f"{column} LIKE ? ESCAPE '\\'", pattern_map[operate]
@@ -0,0 +1,85 @@
+"""
+登录session的本地存储
+
+新进程启动时从本地加载各登录域的cookie, 无需重新登录即可开始请求.
+
+用法:
+    api = MBApi(user, passwd, business_number, user_id, session_store=SessionStore('/var/lib/mbapi/sessions.json'))
+"""
+import os
+import json
+
+from requests.cookies import create_cookie
+
+from .filelock import file_lock
+
+
+class SessionStore():
+    """以json文件保存cookie及各登录域最近一次确认登录有效的时间, 按user和business_number区分
+    读写时持有文件锁, 可在同一主机的多个进程间共享
+    :param path: json文件路径
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f'{path}.lock'
+
+    @staticmethod
+    def make_key(user, business_number):
+        return f'{user}@{business_number}'
+
+    def load(self, key):
+        """读取session
+        :return: (cookie列表, {登录域: 时间戳}), 不存在时返回None
+        """
+        with file_lock(self.lock_path, shared=True):
+            item = self._read().get(key)
+        if item is None:
+            return None
+        cookies = [create_cookie(**cookie) for cookie in item['cookies']]
+        return cookies, item['login_timestamps']
+
+    def save(self, key, cookie_jar, login_timestamps):
+        """保存session
+        :param cookie_jar: requests的cookie jar
+        :param login_timestamps: {登录域: 时间戳}
+        """
+        cookies = [
+            {
+                'name': cookie.name,
+                'value': cookie.value,
+                'domain': cookie.domain,
+                'path': cookie.path,
+                'expires': cookie.expires,
+                'secure': cookie.secure,
+            }
+            for cookie in cookie_jar
+        ]
+        with file_lock(self.lock_path):
+            data = self._read()
+            data[key] = {'cookies': cookies, 'login_timestamps': login_timestamps}
+            self._write(data)
+
+    def delete(self, key):
+        with file_lock(self.lock_path):
+            data = self._read()
+            if data.pop(key, None) is not None:
+                self._write(data)
+
+    def _read(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write(self, data):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        # cookie只允许当前用户读写
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, self.path)
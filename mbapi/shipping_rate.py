@@ -0,0 +1,229 @@
+"""
+物流自定义费用本地价格表
+
+镖局的物流自定义费用规则对每个国家是重量的分段(阶梯或线性)函数.
+ShippingRateTable按国家对规则做一次探测, 把得到的分段函数保存在本地,
+之后的运费查询直接在本地计算, 不再请求镖局接口.
+
+探测时每个区间除端点外还会探测内部若干点, 全部落在端点连线上的区间记为线性(含常数)区间,
+否则在探测点处拆分继续探测, 直到区间宽度不超过resolution, 即找到价格跳变的确切重量.
+跳变区间内部(非resolution整数倍)的重量不插值, 直接请求镖局接口.
+
+用法:
+    table = ShippingRateTable(mb_api, COMMON_SHIPPING_FEE_ID)
+    fee = table.get_shipping_fee(120, "US")
+"""
+import os
+import json
+import time
+import bisect
+import random
+import logging
+import tempfile
+import threading
+from datetime import timedelta
+
+from .exceptions import CalculateShippingFeeError
+
+
+logger = logging.getLogger(__name__)
+
+# 默认探测的重量点(g)
+DEFAULT_PROBE_WEIGHTS = (
+    [1]
+    + list(range(100, 2001, 100))
+    + list(range(2500, 30001, 500))
+)
+DEFAULT_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'mbapi_shipping_rate')
+
+
+class ShippingRateTable():
+    """物流自定义费用的本地价格表
+    :param api: BiaoJuApi实例, 用于探测及校验价格
+    :param shipping_fee_id: 物流自定义费用id
+    :param cache_dir: 价格表保存目录
+    :param ttl: 价格表有效期
+    :param weights: 初始探测的重量点, 相邻两点之间若不是线性的, 会继续探测出价格跳变点
+    :param resolution: 分段点的最小精度, 与重量单位一致
+    :param tolerance: 价格误差容忍度
+    """
+    def __init__(
+        self, api, shipping_fee_id, cache_dir=DEFAULT_CACHE_DIR, ttl=timedelta(days=1),
+        weights=DEFAULT_PROBE_WEIGHTS, resolution=1, tolerance=0.01,
+    ):
+        self.api = api
+        self.shipping_fee_id = shipping_fee_id
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.weights = sorted(weights)
+        self.resolution = resolution
+        self.tolerance = tolerance
+        # country -> (created_at, weights, fees, linear), linear[i]表示weights[i]~weights[i+1]是否为线性区间
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get_shipping_fee(self, weight, country="US", postal_code=""):
+        """获取物流价格, 参数与BiaoJuApi.get_shipping_fee一致
+        价格表不区分邮编, 传入邮编或重量超出价格表范围时直接请求镖局接口
+        """
+        if postal_code:
+            return self.api.get_shipping_fee(self.shipping_fee_id, weight, country, postal_code)
+        _, weights, fees, linear = self._get_table(country)
+        if not weights or not weights[0] <= weight <= weights[-1]:
+            return self.api.get_shipping_fee(self.shipping_fee_id, weight, country)
+        index = bisect.bisect_left(weights, weight)
+        if weights[index] == weight:
+            return fees[index]
+        if not linear[index - 1]:
+            # 跳变区间或探测失败的区间
+            return self.api.get_shipping_fee(self.shipping_fee_id, weight, country)
+        return self._interpolate(
+            weights[index - 1], fees[index - 1], weights[index], fees[index], weight
+        )
+
+    def build(self, country):
+        """探测并保存某个国家的价格表"""
+        logger.info('探测物流价格表, 规则ID: %s, 国家: %s', self.shipping_fee_id, country)
+        points = self._probe(country, self.weights)
+        if not points:
+            raise CalculateShippingFeeError(
+                f'探测物流价格表失败, 物流费用规则ID: {self.shipping_fee_id}, 国家: {country}'
+            )
+        probe_weights = sorted(points)
+        # low -> low~下一个点是否为线性区间
+        linear_map = {}
+        pending = list(zip(probe_weights, probe_weights[1:]))
+        # 每轮把所有待定区间的内部探测点合并为一次批量查询
+        while pending:
+            interiors = {(low, high): self._get_interior_weights(low, high) for low, high in pending}
+            new_weights = set(weight for weights in interiors.values() for weight in weights) - set(points)
+            points.update(self._probe(country, sorted(new_weights)))
+            next_pending = []
+            for (low, high), interior in interiors.items():
+                if any(weight not in points for weight in interior):
+                    # 探测失败, 该区间内的查询请求镖局接口(linear_map默认为False)
+                    continue
+                if all(
+                    abs(points[weight] - self._interpolate(low, points[low], high, points[high], weight))
+                    <= self.tolerance
+                    for weight in interior
+                ):
+                    # 内部探测点也是价格表中的点, 拆出的各小区间同样为线性
+                    for weight in (low, *interior):
+                        linear_map[weight] = True
+                    continue
+                bounds = [low, *interior, high]
+                for start, end in zip(bounds, bounds[1:]):
+                    if end - start <= self.resolution:
+                        # 相邻点价格不同即为跳变点
+                        linear_map[start] = abs(points[start] - points[end]) <= self.tolerance
+                    else:
+                        next_pending.append((start, end))
+            pending = next_pending
+
+        weights = sorted(points)
+        table = (
+            time.time(),
+            weights,
+            [points[weight] for weight in weights],
+            [linear_map.get(weight, False) for weight in weights[:-1]],
+        )
+        self._save(country, table)
+        return table
+
+    def _probe(self, country, weights):
+        """批量查询价格, 返回{重量: 价格}, 查询出错的重量不在结果中"""
+        if not weights:
+            return {}
+        results = self.api.get_shipping_fees(
+            [(self.shipping_fee_id, weight, country) for weight in weights], batch=True
+        )
+        return {result.weight: result.fee for result in results if result.error is None}
+
+    def _get_interior_weights(self, low, high):
+        """区间内部的探测点: 紧邻两端点的点及四分位点, 均取resolution的整数倍"""
+        candidates = [low + self.resolution, high - self.resolution]
+        candidates.extend(low + (high - low) * i / 4 for i in range(1, 4))
+        weights = set()
+        for weight in candidates:
+            weight = round(weight / self.resolution) * self.resolution
+            if low < weight < high:
+                weights.add(weight)
+        return sorted(weights)
+
+    def verify(self, country, samples=5):
+        """抽样与镖局接口比对价格, 价格偏差超过tolerance时作废该国家的价格表
+        :return: 价格表是否有效
+        """
+        _, weights, _, _ = self._get_table(country)
+        if not weights:
+            return False
+        for _ in range(samples):
+            weight = round(random.uniform(weights[0], weights[-1]) / self.resolution) * self.resolution
+            weight = min(max(weight, weights[0]), weights[-1])
+            try:
+                live_fee = self.api.get_shipping_fee(self.shipping_fee_id, weight, country)
+            except CalculateShippingFeeError:
+                continue
+            local_fee = self.get_shipping_fee(weight, country)
+            if abs(live_fee - local_fee) > self.tolerance:
+                logger.warning(
+                    '物流价格表已过时, 规则ID: %s, 国家: %s, 重量: %s, 本地价格: %s, 实际价格: %s',
+                    self.shipping_fee_id, country, weight, local_fee, live_fee,
+                )
+                self.invalidate(country)
+                return False
+        return True
+
+    def invalidate(self, country=None):
+        """作废价格表, country为None时作废该规则所有国家的价格表"""
+        with self._lock:
+            countries = [country] if country else list(self._tables)
+            for country in countries:
+                self._tables.pop(country, None)
+                try:
+                    os.remove(self._get_path(country))
+                except FileNotFoundError:
+                    pass
+
+    def _get_table(self, country):
+        table = self._tables.get(country)
+        if table is None or self._is_expired(table):
+            with self._lock:
+                table = self._tables.get(country)
+                if table is None or self._is_expired(table):
+                    table = self._load(country)
+                    if table is None or self._is_expired(table):
+                        table = self.build(country)
+                    self._tables[country] = table
+        return table
+
+    def _is_expired(self, table):
+        return time.time() - table[0] > self.ttl.total_seconds()
+
+    @staticmethod
+    def _interpolate(low, low_fee, high, high_fee, weight):
+        return low_fee + (high_fee - low_fee) * (weight - low) / (high - low)
+
+    def _get_path(self, country):
+        return os.path.join(self.cache_dir, f'{self.shipping_fee_id}_{country}.json')
+
+    def _load(self, country):
+        try:
+            with open(self._get_path(country), encoding='utf-8') as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if 'linear' not in data:
+            # 旧格式的价格表没有区间类型, 重新探测
+            return None
+        return (data['created_at'], data['weights'], data['fees'], data['linear'])
+
+    def _save(self, country, table):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        created_at, weights, fees, linear = table
+        path = self._get_path(country)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'created_at': created_at, 'weights': weights, 'fees': fees, 'linear': linear}, f)
+        os.replace(tmp_path, path)
@@ -0,0 +1,161 @@
+"""
+调用追踪
+
+MBApi的每次远程请求及组合操作(如download_order_xlsx_for_5miles)都会生成一个Span,
+Span记录接口, 耗时, 重试次数及父操作, 通过钩子函数输出后可以还原出调用树.
+
+用法:
+    def after(span):
+        print(span.path, span.endpoint, span.duration)
+    api.tracer.add_hook(after=after)
+"""
+import time
+import inspect
+import functools
+import contextvars
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+
+_current_span = contextvars.ContextVar('mbapi_current_span', default=None)
+
+
+@dataclass
+class Span():
+    """
+    :param name: 操作名称, 远程请求为http
+    :param endpoint: 远程请求的接口名, 组合操作为空
+    :param parent: 父操作的Span
+    :param retries: urllib3重试次数
+    :param status: http状态码
+    :param error: 操作抛出的异常
+    :param attrs: 其他信息
+    """
+    name: str
+    endpoint: str = ''
+    parent: 'Span' = None
+    start: float = field(default_factory=time.perf_counter)
+    end: float = None
+    retries: int = 0
+    status: int = None
+    error: Exception = None
+    attrs: dict = field(default_factory=dict)
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def depth(self):
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    @property
+    def path(self):
+        """从根操作到当前操作的名称, 如download_order_xlsx_for_5miles > export_order > http"""
+        names = []
+        span = self
+        while span is not None:
+            names.append(span.name)
+            span = span.parent
+        return ' > '.join(reversed(names))
+
+
+class Tracer():
+    """Span的创建及钩子管理
+    before钩子在操作开始时调用, after钩子在操作结束后调用, 参数均为Span
+    """
+    def __init__(self):
+        self.before_hooks = []
+        self.after_hooks = []
+
+    def add_hook(self, before=None, after=None):
+        if before is not None:
+            self.before_hooks.append(before)
+        if after is not None:
+            self.after_hooks.append(after)
+
+    def remove_hook(self, hook):
+        for hooks in (self.before_hooks, self.after_hooks):
+            if hook in hooks:
+                hooks.remove(hook)
+
+    @staticmethod
+    def current_span():
+        return _current_span.get()
+
+    def start_span(self, name, endpoint='', **attrs):
+        """创建以当前Span为父操作的Span, 不设置为当前Span"""
+        span = Span(name, endpoint, parent=_current_span.get(), attrs=attrs)
+        for hook in self.before_hooks:
+            hook(span)
+        return span
+
+    def finish_span(self, span):
+        span.end = time.perf_counter()
+        for hook in self.after_hooks:
+            hook(span)
+
+    @contextmanager
+    def span(self, name, endpoint='', **attrs):
+        span = self.start_span(name, endpoint, **attrs)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = e
+            raise
+        finally:
+            _current_span.reset(token)
+            self.finish_span(span)
+
+
+def traced(func):
+    """把MBApi方法记录为一个组合操作Span
+    生成器方法的Span从开始迭代持续到迭代结束, 只在生成器内部执行时作为当前Span
+    """
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def generator_wrapper(self, *args, **kw):
+            span = self.tracer.start_span(func.__name__)
+            gen = func(self, *args, **kw)
+            try:
+                while True:
+                    token = _current_span.set(span)
+                    try:
+                        item = next(gen)
+                    except StopIteration:
+                        return
+                    finally:
+                        _current_span.reset(token)
+                    yield item
+            except GeneratorExit:
+                raise
+            except BaseException as e:
+                span.error = e
+                raise
+            finally:
+                gen.close()
+                self.tracer.finish_span(span)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kw):
+        with self.tracer.span(func.__name__):
+            return func(self, *args, **kw)
+    return wrapper
+
+
+def bind_span(func):
+    """让线程池中执行的func以当前Span为父操作"""
+    span = _current_span.get()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kw):
+        token = _current_span.set(span)
+        try:
+            return func(*args, **kw)
+        finally:
+            _current_span.reset(token)
+    return wrapper
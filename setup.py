@@ -16,5 +16,9 @@ setuptools.setup(
     long_description=openf("README.md").read(),
     packages=find_packages(),
     install_requires=[line.strip() for line in openf("requirements.txt") if line.strip()],
+    extras_require={
+        "async": ["aiohttp>=3,<4"],
+        "arrow": ["pyarrow>=1"],
+    },
     python_requires=">=3.6",
 )
@@ -0,0 +1,194 @@
+"""
+多线程共享MBApi时的单次重新登录压力测试
+
+本地启动一个模拟马帮的http服务, 所有请求经由_LocalAdapter转发到该服务,
+服务端按X-Original-Host区分原请求的域名.
+"""
+import json
+import time
+import uuid
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+import requests
+from requests.adapters import HTTPAdapter
+
+from mbapi import MBApi
+from mbapi.base import LOGIN_CHECK_DOMAINS
+from mbapi.constant import MB_API
+
+
+THREAD_COUNT = 30
+
+
+class _StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = THREAD_COUNT * 4
+
+
+class _StandInState():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token = 'stale'
+        self.login_count = 0
+
+
+def _make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self._handle()
+
+        def do_POST(self):
+            self._handle()
+
+        def _handle(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode('utf-8') if length else ''
+            parsed = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            query.update({k: v[0] for k, v in parse_qs(body).items()})
+            mod = query.get('mod', '')
+            cookies = dict(
+                item.strip().split('=', 1) for item in (self.headers.get('Cookie') or '').split(';') if '=' in item
+                )
+
+            if mod == 'main.doLogin':
+                # 登录较慢, 保证其他线程在登录过程中到达
+                time.sleep(0.2)
+                with state.lock:
+                    state.login_count += 1
+                    state.token = uuid.uuid4().hex
+                    token = state.token
+                self._send(
+                    {'success': True},
+                    cookies={'MABANG_ERP_PRO_MEMBERINFO_LOGIN_COOKIE': token, 'sid': token},
+                    )
+                return
+            with state.lock:
+                token = state.token
+            if mod in ('stock.list', 'vmain.mbLogin') or query.get('a') == 'erpLogin':
+                # 其他登录域的登录请求, 下发当前有效的登录cookie
+                self._send('', cookies={'sid': token})
+                return
+
+            valid = cookies.get('sid') == token
+            if mod == 'messageNotice.messageList':
+                self._send({'success': valid})
+            elif parsed.path == '/' or (parsed.path == '/index.php' and not query):
+                self._send('企业编号' if valid else '请登录')
+            elif valid:
+                self._send({'success': True, 'message': ''})
+            else:
+                self._send({'success': False, 'message': '登录信息已超时'})
+
+        def _send(self, data, cookies=None):
+            body = (data if isinstance(data, str) else json.dumps(data)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (cookies or {}).items():
+                self.send_header('Set-Cookie', f'{name}={value}; Path=/')
+            self.end_headers()
+            self.wfile.write(body)
+    return Handler
+
+
+class _LocalAdapter(HTTPAdapter):
+    """把请求转发到本地服务, 原域名放在X-Original-Host中"""
+    def __init__(self, base_url, **kw):
+        self.base_url = base_url
+        super().__init__(**kw)
+
+    def send(self, request, **kw):
+        request = request.copy()
+        parsed = urlsplit(request.url)
+        request.headers['X-Original-Host'] = parsed.netloc
+        request.url = self.base_url + parsed.path + (f'?{parsed.query}' if parsed.query else '')
+        return super().send(request, **kw)
+
+
+@pytest.fixture
+def stand_in():
+    state = _StandInState()
+    server = _StandInServer(('127.0.0.1', 0), _make_handler(state))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield state, 'http://%s:%s' % server.server_address
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_api(base_url):
+    class StandInMBApi(MBApi):
+        def _make_request_session(self):
+            r_session = requests.Session()
+            adapter = _LocalAdapter(base_url, pool_maxsize=THREAD_COUNT)
+            r_session.mount('http://', adapter)
+            r_session.mount('https://', adapter)
+            return r_session
+
+    return StandInMBApi('user', 'passwd', 'business_number', 'user_id')
+
+
+def test_concurrent_expired_requests_login_once(stand_in):
+    state, base_url = stand_in
+    api = make_api(base_url)
+    # 登录状态检测已通过, 登录失效只能从请求返回中发现
+    now = datetime.now()
+    for domain in LOGIN_CHECK_DOMAINS:
+        api._login_datetimes[domain] = now
+
+    barrier = threading.Barrier(THREAD_COUNT)
+    results = []
+    errors = []
+
+    def worker():
+        barrier.wait()
+        try:
+            results.append(api.request('post', MB_API, params={'mod': 'order.stress'}))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREAD_COUNT)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert len(results) == THREAD_COUNT
+    assert all(result['success'] for result in results)
+    assert state.login_count == 1
+    assert api.metrics.snapshot()['order.stress']['relogins'] == THREAD_COUNT
+
+
+def test_concurrent_first_requests_check_login_once(stand_in):
+    state, base_url = stand_in
+    api = make_api(base_url)
+
+    barrier = threading.Barrier(THREAD_COUNT)
+    errors = []
+
+    def worker():
+        barrier.wait()
+        try:
+            api.request('post', MB_API, params={'mod': 'order.stress'})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(THREAD_COUNT)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert state.login_count == 1